@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 from datetime import date, timedelta, datetime
-from database import get_db, init_db
+from database import SessionLocal, init_db
 from models import Customer, Order, Interaction, Quote
 import utils
 
@@ -11,9 +11,25 @@ st.set_page_config(page_title="간편 CRM", layout="wide", page_icon="💼")
 # Initialize DB
 init_db()
 
-# Function to get DB session
+# Function to get DB session (callers close it, which returns the connection to the pool)
 def get_session():
-    return next(get_db())
+    return SessionLocal()
+
+# --- Initial Setup & Migration ---
+# Runs once per server process; only pending schema_version steps are applied.
+@st.cache_resource
+def run_auto_migration():
+    try:
+        db = get_session()
+        logs = utils.run_db_migration(db)
+        db.close()
+        return logs
+    except Exception as e:
+        return [f"Migration Error: {e}"]
+
+migration_logs = run_auto_migration()
+if migration_logs and "Error" in str(migration_logs):
+    st.error(f"DB Update Failed: {migration_logs}")
 
 # --- Sidebar Navigation ---
 st.sidebar.title("💼 CRM 시스템")
@@ -89,6 +105,8 @@ if page == "대시보드":
 
     # Fetch Data
     activity = utils.get_recent_messenger_activity(db, days=60)
+    # Date-keyed index: calendar cells and the detail pane do O(1) lookups per day
+    activity_by_date, activity_counts = utils.index_activity_by_date(activity)
     
     # --- GLOBAL FILTER (User Request) ---
     # We rely on save-time filtering now. 
@@ -143,8 +161,9 @@ if page == "대시보드":
                         current_d = date(sel_year, sel_month, day)
                         
                         # Check events (Global filtered)
-                        has_orders = any(o['date'] == current_d for o in activity['orders'])
-                        has_payments = any(p['date'] == current_d for p in activity['payments'])
+                        day_counts = activity_counts.get(current_d, {})
+                        has_orders = day_counts.get('orders', 0) > 0
+                        has_payments = day_counts.get('payments', 0) > 0
                         
                         # Label Logic: Date Top, Icon Bottom
                         # Use narrower layout logic
@@ -167,9 +186,10 @@ if page == "대시보드":
         sel_d = st.session_state['selected_date']
         st.markdown(f"### 🗓️ {sel_d.strftime('%Y-%m-%d')} 상세 내역")
         
-        # Filter (Using Global Lists)
-        d_orders = [o for o in activity['orders'] if o['date'] == sel_d]
-        d_payments = [p for p in activity['payments'] if p['date'] == sel_d]
+        # Lookup (Using Date Index)
+        day_items = activity_by_date.get(sel_d, {})
+        d_orders = day_items.get('orders', [])
+        d_payments = day_items.get('payments', [])
         
         if not d_orders and not d_payments:
             st.info("기록된 내역이 없습니다.")
@@ -204,88 +224,25 @@ if page == "대시보드":
                     
                 # Payments
                 if d_payments:
-                    # 1. Pre-process to extract amounts and Deduplicate
+                    # 1. Pre-process amounts
+                    # (duplicate reports are rejected at ingest with the message time; the stored
+                    # log_date is only a day, so re-checking here would merge same-day payments)
                     unique_payments = []
-                    last_processed = None # {amount: int, time: datetime, sender: str}
                     
-                    import re
                     from datetime import datetime, timedelta
 
                     d_payments_sorted = sorted(d_payments, key=lambda x: x.get('date', datetime.min))
 
                     for p in d_payments_sorted:
-                         # Extract Amount Logic (Same as before)
-                        final_amt = "금액 미상"
-                        final_amt_val = 0
-                        context_snippet = ""
-                        
-                        # 1. Direct Regex
-                        direct_match = re.search(r'([\d,]+)(원|만원)', p['text'])
-                        amount_found = False
-                        
-                        if direct_match:
-                            val_str = direct_match.group(1).replace(",", "")
-                            try:
-                                val_int = int(val_str)
-                                if val_int > 0:
-                                    final_amt = direct_match.group(0)
-                                    final_amt_val = val_int
-                                    amount_found = True
-                            except: pass
-                        
-                        if not amount_found and 'id' in p:
-                            # 2. Context Search
-                            context_text = utils.get_interaction_context(db, p['id'], window=5, limit_to_sender=p['sender'])
-                            all_matches = re.findall(r'([\d,]+)(원|만원)', context_text)
-                            
-                            valid_candidates = []
-                            for m in all_matches:
-                                try:
-                                    val = int(m[0].replace(",", ""))
-                                    if val > 0:
-                                        valid_candidates.append((val, f"{m[0]}{m[1]}"))
-                                except: pass
-                            
-                            if valid_candidates:
-                                # Pick last one
-                                final_amt_val, final_amt = valid_candidates[-1]
-                                context_snippet = f"문맥 감지: {final_amt}"
-                        
-                        # DEDUPLICATION LOGIC
-                        # If same Amount AND Same Sender AND Time Diff < 60s
-                        is_duplicate = False
-                        p_time = p.get('date') # Assuming 'date' is a datetime object from utils
-                        # Wait, utils.py sets 'date': i.log_date. database.py says log_date allows null? 
-                        # Assuming it's valid datetime.
+                        # Amount was extracted at ingest (Interaction.amount)
+                        final_amt_val = p.get('amount') or 0
+                        final_amt = f"{final_amt_val:,}원" if final_amt_val else "금액 미상"
                         
-                        if last_processed and final_amt_val > 0:
-                            prev_amt = last_processed['amount']
-                            prev_time = last_processed['time']
-                            prev_sender = last_processed['sender']
-                            
-                            if (prev_amt == final_amt_val and 
-                                prev_sender == p['sender'] and 
-                                p_time and prev_time):
-                                delta = p_time - prev_time
-                                if abs(delta.total_seconds()) < 60: # Within 60 seconds
-                                    is_duplicate = True
-                        
-                        if not is_duplicate:
-                            # Add to unique list
-                            p_data = {
-                                'data': p,
-                                'amt_str': final_amt,
-                                'amt_val': final_amt_val,
-                                'snippet': context_snippet
-                            }
-                            unique_payments.append(p_data)
-                            # Update last processed only if valid amount (to chain duplicates)
-                            if final_amt_val > 0:
-                                last_processed = {
-                                    'amount': final_amt_val,
-                                    'time': p_time,
-                                    'sender': p['sender']
-                                }
+                        unique_payments.append({
+                            'data': p,
+                            'amt_str': final_amt,
+                            'amt_val': final_amt_val
+                        })
                     
                     # RENDER
                     st.caption(f"💰 입금 확인 ({len(unique_payments)})")
@@ -317,24 +274,7 @@ if page == "대시보드":
         
     st.divider()
 
-    # --- Initial Setup & Migration ---
-@st.cache_resource
-def run_auto_migration():
-    try:
-        from database import get_db
-        import utils
-        db = next(get_db())
-        logs = utils.run_db_migration(db)
-        db.close()
-        return logs
-    except Exception as e:
-        return [f"Migration Error: {e}"]
-
-migration_logs = run_auto_migration()
-if migration_logs and "Error" in str(migration_logs):
-    st.error(f"DB Update Failed: {migration_logs}")
-
-# --- Analysis Section ---
+    # --- Analysis Section ---
     st.subheader("📈 매출 분석")
     chart_col1, chart_col2 = st.columns(2)
     
@@ -359,7 +299,14 @@ if migration_logs and "Error" in str(migration_logs):
     
     with chart_col1:
         st.write("**월별 매출 추이**")
-        trend_data = utils.get_monthly_sales_trend(db)
+        trend_months = st.selectbox("기간", [6, 12, 24, 0], index=1, format_func=lambda m: f"최근 {m}개월" if m else "전체", key="trend_months")
+        trend_start = None
+        if trend_months:
+            # First day of the month, (trend_months - 1) months ago
+            first_of_month = date.today().replace(day=1)
+            y, m = divmod(first_of_month.year * 12 + first_of_month.month - 1 - (trend_months - 1), 12)
+            trend_start = date(y, m + 1, 1)
+        trend_data = utils.get_monthly_sales_trend(db, start_date=trend_start)
         if trend_data["Date"]:
             df_trend = pd.DataFrame(trend_data)
             # Matplotlib Chart
@@ -1125,23 +1072,39 @@ elif page == "데이터 입력":
         
         if uploaded_file is not None:
             try:
-                df = pd.read_csv(uploaded_file)
+                # Preview only the first rows; the import itself streams the file in chunks
+                df_preview = pd.read_csv(uploaded_file, nrows=5)
+                uploaded_file.seek(0)
                 st.subheader("미리보기")
-                st.dataframe(df.head(), width='stretch')
+                st.dataframe(df_preview, width='stretch')
                 
-                if st.button("업로드 시작", type="primary"):
+                checkpoint = utils.get_csv_import_checkpoint(uploaded_file)
+                btn_label = "업로드 시작"
+                if checkpoint:
+                    st.info(f"이전에 중단된 업로드가 있습니다. {checkpoint['chunks_done'] * utils.CSV_CHUNK_SIZE:,}행 이후부터 이어서 진행합니다.")
+                    btn_label = "이어서 업로드"
+                
+                if st.button(btn_label, type="primary"):
                     db = get_session()
-                    with st.spinner("데이터 처리 중입니다..."):
-                        stats = utils.process_csv_data(db, df)
+                    progress_bar = st.progress(0.0, text="데이터 처리 중입니다...")
+                    
+                    def on_progress(fraction, chunks_done):
+                        progress_bar.progress(fraction, text=f"데이터 처리 중입니다... ({chunks_done * utils.CSV_CHUNK_SIZE:,}행 처리)")
+                    
+                    try:
+                        stats = utils.import_csv_in_chunks(db, uploaded_file, progress_callback=on_progress)
+                    finally:
+                        db.close()
                     
-                    st.success("완료!")
+                    if stats['completed']:
+                        st.success("완료!")
+                    else:
+                        st.warning("일부 데이터를 저장하지 못해 업로드가 중단되었습니다. 같은 파일을 다시 업로드하면 실패한 부분부터 이어서 진행합니다.")
                     col1, col2, col3 = st.columns(3)
                     col1.metric("신규 고객", stats['new_customers'])
                     col2.metric("신규 주문", stats['new_orders'])
                     col3.metric("에러 건수", stats['errors'])
                     
-                    db.close()
-                    
             except Exception as e:
                 st.error(f"파일 읽기 오류: {e}")
 
@@ -1240,10 +1203,14 @@ elif page == "메신저 입력":
             
             if st.button("2. 확정 및 저장하기", type="primary"):
                 saved_count = 0
+                dedup = utils.PaymentDeduplicator(window_seconds=60)
                 for msg in parsed_data:
                     cid = sender_mapping.get(msg['sender'])
                     if not cid:
                         continue
+                    # Same sender + same amount within 60s -> already saved once
+                    if msg['type'] == 'PAYMENT' and dedup.is_duplicate(msg['sender'], msg.get('value', 0), msg['date']):
+                        continue
                         
                     # Save logic
                     try:
@@ -1263,14 +1230,13 @@ elif page == "메신저 입력":
                             status = "완료"
                             # Fix: Use tags that get_recent_messenger_activity expects
                             tag = f"[{msg['type_label']}]"
-                            content_prefix = ""
+                            amount = None
                             
                             if msg['type'] == 'PAYMENT':
                                 tag = "[입금확인]"
-                                # ⚠️ CRITICAL: Embed detected value into text because Interaction table has no amount field
-                                # and strict filtering discards the context message containing the number.
+                                # Detected value (incl. context lookback) is stored in Interaction.amount
                                 if msg.get('value', 0) > 0:
-                                    content_prefix = f"({msg['value']:,}원) "
+                                    amount = msg['value']
                                     
                             elif msg['type'] == 'PRICE':
                                 tag = "[단가변동]"
@@ -1278,10 +1244,11 @@ elif page == "메신저 입력":
                             utils.add_interaction(
                                 db,
                                 cid,
-                                f"{tag} {content_prefix}{msg['text']}",
+                                f"{tag} {msg['text']}",
                                 None,
                                 status,
-                                log_date=msg['date'].date()
+                                log_date=msg['date'].date(),
+                                amount=amount
                             )
                             saved_count += 1
                     except Exception as e:
@@ -1437,10 +1404,13 @@ elif page == "AI CRM":
                             finally:
                                 db_session.close()
                                 
-                            result = utils.analyze_text_with_gemini_v4(api_key, user_text, product_names=prod_names)
+                            result, from_cache = utils.analyze_text_with_gemini_v4(api_key, user_text, product_names=prod_names)
                             
                             if "error" in result:
                                 st.error(f"AI 분석 실패: {result['error']}")
+                            elif from_cache:
+                                st.success("✅ 분석 완료! (⚡ 캐시된 결과)")
+                                st.session_state['ai_result'] = result  # Store result in session state
                             else:
                                 st.success("✅ 분석 완료!")
                                 st.session_state['ai_result'] = result  # Store result in session state
@@ -1451,6 +1421,21 @@ elif page == "AI CRM":
                     # Processing done
                     st.session_state['ai_processing'] = False
 
+            # AI cache hit/miss (hits = answered without an API call)
+            with st.expander("⚡ AI 캐시 현황", expanded=False):
+                db_session = get_session()
+                try:
+                    cache_stats = utils.get_ai_cache_stats(db_session)
+                    m1, m2, m3 = st.columns(3)
+                    m1.metric("캐시 적중 (절약된 API 호출)", cache_stats["hits"])
+                    m2.metric("캐시 미스", cache_stats["misses"])
+                    m3.metric("적중률", f"{cache_stats['hit_rate']}%")
+                    st.caption(f"저장된 분석 {cache_stats['entries']}건 · 보관 {utils.AI_CACHE_TTL_HOURS}시간 · 최대 {utils.AI_CACHE_MAX_ENTRIES}건")
+                except Exception as e:
+                    st.caption(f"캐시 정보를 불러올 수 없습니다: {e}")
+                finally:
+                    db_session.close()
+
             # Display Results (Persistent) - Top Right: Customer Info
             if 'ai_result' in st.session_state and st.session_state['ai_result']:
                 result = st.session_state['ai_result']
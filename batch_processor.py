@@ -1,13 +1,21 @@
 import os
+import abc
 import json
+import time
 import datetime
 import re
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.orm import Session
-from database import get_db
+from database import session_scope, init_db
 import utils
 from models import Customer
+from message_rules import parse_header, RuleMatcher, iter_messages
 
-# State file to track read positions
+# Legacy JSON state (read positions before they moved to the log_checkpoints table).
+# Only read once, to seed today's checkpoint on the first run after upgrading.
 STATE_FILE = "batch_state.json"
 
 # Log directories (User provided)
@@ -15,12 +23,44 @@ BASE_DIR = r"C:\Users\rusil\Documents\하이웍스 채팅저장"
 CHINA_ROOM = r"(중국1) 영업팀- 주문제작 영업방"
 KOREA_ROOM = r"(한국2) 영업팀-국내 주문제작 관해 남기는방"
 
-def get_todays_filepaths():
-    today_str = datetime.date.today().strftime("%Y-%m-%d") + ".txt"
-    return {
-        "CHINA": os.path.join(BASE_DIR, CHINA_ROOM, today_str),
-        "KOREA": os.path.join(BASE_DIR, KOREA_ROOM, today_str)
-    }
+# Buffered rows per bulk INSERT (the whole file is still one transaction)
+FLUSH_EVERY = 500
+
+# Lines kept per room for payment amount lookback (same window the dashboard used)
+PAYMENT_CONTEXT_LINES = 5
+
+# Same sender + same amount within this many seconds = one payment reported twice
+PAYMENT_DEDUP_SECONDS = 60
+
+# Bytes of already-imported log re-read to seed a fresh room processor (amount lookback
+# and payment de-dup only need the last minutes before the resume point)
+SEED_BYTES = 64 * 1024
+
+# Room keyword rules, compiled once into a single matcher per room (list order = priority)
+CHINA_RULES = [
+    {"type": "PRICE", "keywords": ["단가", "가격"]},
+    {"type": "SCHEDULE", "keywords": ["제작기간", "일정"]},
+]
+KOREA_RULES = [
+    {"type": "PAYMENT", "keywords": ["입금", "카드", "송금"]},
+    {"type": "DOCUMENT", "keywords": ["발주서", "견적서"]},
+    {"type": "ORDER", "keywords": ["기업", "업체"]},
+    # Confirmations/questions that mention a company are not orders
+    {"type": "NOT_ORDER", "keywords": ["확인", "네", "감사", "수고", "문의", "?"]},
+]
+CHINA_MATCHER = RuleMatcher(CHINA_RULES)
+KOREA_MATCHER = RuleMatcher(KOREA_RULES)
+
+# Day files written by the messenger export: "YYYY-MM-DD.txt"
+DATED_FILE_PATTERN = re.compile(r"^(\d{4}-\d{2}-\d{2})\.txt$")
+
+# Parallel file workers for --catch-up (env: BATCH_WORKERS)
+BATCH_WORKERS = int(os.environ.get("BATCH_WORKERS", min(4, os.cpu_count() or 1)))
+
+# Parallel workers on SQLite can still time out on each other's commits
+# ("database is locked" after busy_timeout): retry the file with a growing delay
+LOCK_RETRIES = 5
+LOCK_RETRY_DELAY = 0.5  # seconds, doubled per retry
 
 def load_state():
     if os.path.exists(STATE_FILE):
@@ -28,129 +68,206 @@ def load_state():
             return json.load(f)
     return {}
 
-def save_state(state):
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
+def checkpoint_source(state_key, filepath):
+    # Log files are per day, so the offset belongs to (room, file) and not just the room
+    return f"{state_key}:{os.path.basename(filepath)}"
 
-def read_new_content(filepath, state_key, current_state):
-    if not os.path.exists(filepath):
-        print(f"File not found: {filepath}")
-        return ""
-    
-    last_pos = current_state.get(state_key, {}).get("last_pos", 0)
+def get_start_offset(db: Session, state_key, filepath, legacy_state):
+    pos = utils.get_log_checkpoint(db, checkpoint_source(state_key, filepath))
+    if pos is not None:
+        return pos
+    # Seed from batch_state.json if it was written on the same day as this file
+    legacy = legacy_state.get(state_key, {})
+    if legacy.get("last_updated", "").startswith(os.path.basename(filepath)[:10]):
+        return legacy.get("last_pos", 0)
+    return 0
+
+def read_new_lines(filepath, last_pos, progress):
+    """
+    Streams the lines of the complete messages after last_pos (bounded memory).
+    progress["pos"] is advanced to the end of each message once its lines are consumed;
+    a message that may still be growing is left for the next run (see iter_messages).
+    The offset is not saved here: process_room commits it with the file's rows.
+    """
+    # Day files from before today are finished, so their last message is complete too
+    final = os.path.basename(filepath)[:10] < datetime.date.today().isoformat()
     
-    # If file is smaller than last_pos, it might have been reset/rotated
-    current_size = os.path.getsize(filepath)
-    if current_size < last_pos:
-        last_pos = 0
-        
-    content = ""
+    with open(filepath, "rb") as f:
+        for message, end in iter_messages(f, last_pos, final=final):
+            yield from message
+            progress["pos"] = end
+
+def read_seed_lines(filepath, end):
+    """Lines of the messages in the last SEED_BYTES before byte offset end."""
+    begin = max(0, end - SEED_BYTES)
+    with open(filepath, "rb") as f:
+        if begin:
+            # Start at the next line boundary
+            f.seek(begin - 1)
+            f.readline()
+            begin = f.tell()
+        data = f.read(max(0, end - begin))
+    lines = data.decode("utf-8", errors="ignore").splitlines()
+    # Drop the rest of a message that started before the window (its sender is unknown)
+    for i, line in enumerate(lines):
+        if parse_header(line.strip()):
+            return lines[i:]
+    return []
+
+def previous_day_file(filepath):
+    """The room's day file before filepath ("YYYY-MM-DD.txt"), or None."""
+    match = DATED_FILE_PATTERN.match(os.path.basename(filepath))
+    if not match:
+        return None
     try:
-        with open(filepath, "r", encoding="utf-8", errors='ignore') as f:
-            f.seek(last_pos)
-            content = f.read()
-            new_pos = f.tell()
+        day = datetime.date.fromisoformat(match.group(1)) - datetime.timedelta(days=1)
+    except ValueError:
+        return None
+    path = os.path.join(os.path.dirname(filepath), f"{day.isoformat()}.txt")
+    return path if os.path.exists(path) else None
+
+def seed_processor(processor, filepath, start):
+    """
+    Restores a fresh processor's state from the messages just before byte offset start:
+    this file's already-imported part and, near the start of a day, the end of the
+    previous day's file. So a payment reported again after a restart, a later run or
+    midnight is still recognised as a duplicate.
+    """
+    if start < SEED_BYTES:
+        previous = previous_day_file(filepath)
+        if previous:
+            processor.seed(read_seed_lines(previous, os.path.getsize(previous)))
+    if start:
+        processor.seed(read_seed_lines(filepath, start))
+
+class RoomProcessor(abc.ABC):
+    """
+    Stateful processor for one room's log. The current sender/date, the recent lines
+    used for payment amount lookback and any de-dup state carry across calls, so a
+    room can be fed file after file (or poll after poll) without losing context.
+    
+    seed(lines) replays lines that were already imported to restore that state
+    without writing anything (see seed_processor).
+    """
+    def __init__(self):
+        self.current_sender = "Unknown"
+        self.current_date = datetime.date.today()
+        self.current_time = None
+        self.recent_lines = deque(maxlen=PAYMENT_CONTEXT_LINES)  # (sender, line) for amount lookback
+    
+    def _content_lines(self, lines):
+        """Tracks headers and yields (line, sender's previous lines) for each message line."""
+        for line in lines:
+            line = line.strip()
+            if not line: continue
             
-        # Update state immediately (or after processing)
-        if state_key not in current_state:
-            current_state[state_key] = {}
-        current_state[state_key]["last_pos"] = new_pos
-        current_state[state_key]["last_updated"] = str(datetime.datetime.now())
-        
-        return content
-    except Exception as e:
-        print(f"Error reading {filepath}: {e}")
-        return ""
+            header = parse_header(line)
+            if header:
+                # Update contexts
+                self.current_time, self.current_sender = header
+                self.current_date = self.current_time.date()
+                continue
+            
+            # Sender's previous lines (payment amount lookback), then remember this one
+            context = [l for s, l in self.recent_lines if s == self.current_sender]
+            self.recent_lines.append((self.current_sender, line))
+            yield line, context
+    
+    def seed(self, lines):
+        for line, context in self._content_lines(lines):
+            self.observe(line, context)
+    
+    def process(self, db: Session, lines):
+        """
+        lines: iterable of log lines (a list, or streamed by read_new_lines)
+        Returns the number of rows written; committed by the caller with the offset.
+        """
+        writer = utils.BulkLogWriter(db, flush_every=FLUSH_EVERY)
+        for line, context in self._content_lines(lines):
+            self.handle(db, writer, line, context)
+        # Remaining buffered rows
+        return writer.flush()
+    
+    def observe(self, line, context):
+        """State update for an already-imported line (seed)."""
+        pass
+    
+    @abc.abstractmethod
+    def handle(self, db: Session, writer, line, context):
+        """Stages the rows for one message line (room rules)."""
 
-def process_china_log(db: Session, text):
+class ChinaRoomProcessor(RoomProcessor):
     """
     China Room Rules:
     - Keywords: 단가, 가격 -> [단가 변동] (Interaction)
     - Keywords: 제작기간, 일정 -> [납기 확인] (Interaction)
     """
-    lines = text.splitlines()
-    header_pattern = re.compile(r"^\[(\d{4}-\d{2}-\d{2}) (오전|오후) (\d{1,2}:\d{2})\] (.*)")
-    
-    current_sender = "Unknown"
-    current_date = datetime.date.today()
-    
-    for line in lines:
-        line = line.strip()
-        if not line: continue
-        
-        match = header_pattern.match(line)
-        if match:
-            # Update contexts
-            date_str, ampm, time_str, sender = match.groups()
-            current_sender = sender
-            # Simple date parse (or assume today)
-            try:
-                current_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-            except: pass
-            continue
-            
-        # Analyze Content
-        if any(k in line for k in ["단가", "가격"]):
+    def handle(self, db: Session, writer, line, context):
+        # Analyze Content (one pass over the line; PRICE wins over SCHEDULE)
+        rule = CHINA_MATCHER.classify(line)
+        if rule == "PRICE":
             print(f"[CHINA] Price Logic: {line}")
             # Log as Interaction
-            utils.add_interaction(
-                db, 
-                get_or_create_guest(db, current_sender).id, 
+            writer.add_interaction(
+                get_or_create_guest(db, self.current_sender), 
                 f"[단가변동] {line}", 
                 None, 
                 "확인필요", 
-                log_date=current_date
+                log_date=self.current_date
             )
             
-        elif any(k in line for k in ["제작기간", "일정"]):
+        elif rule == "SCHEDULE":
              print(f"[CHINA] Schedule Logic: {line}")
-             utils.add_interaction(
-                db, 
-                get_or_create_guest(db, current_sender).id, 
+             writer.add_interaction(
+                get_or_create_guest(db, self.current_sender), 
                 f"[납기확인] {line}", 
                 None, 
                 "진행중", 
-                log_date=current_date
+                log_date=self.current_date
             )
 
-def process_korea_log(db: Session, text):
+class KoreaRoomProcessor(RoomProcessor):
     """
     Korea Room Rules:
     - Keywords: 입금, 카드 -> [입금 확인] (Interaction)
     - Keywords: 발주서, 기업, 업체 -> [발주처 확인] (Order)
     """
-    lines = text.splitlines()
-    header_pattern = re.compile(r"^\[(\d{4}-\d{2}-\d{2}) (오전|오후) (\d{1,2}:\d{2})\] (.*)")
+    def __init__(self):
+        super().__init__()
+        self.dedup = utils.PaymentDeduplicator(window_seconds=PAYMENT_DEDUP_SECONDS)
     
-    current_sender = "Unknown"
-    current_date = datetime.date.today()
+    def _payment_amount(self, line, context):
+        """(amount, is_duplicate) for a payment line; remembers new reports."""
+        # Amount: this line first, else the sender's previous lines
+        amount = utils.extract_payment_amount(line, context)
+        duplicate = self.dedup.is_duplicate(self.current_sender, amount, self.current_time or self.current_date)
+        return amount, duplicate
     
-    for line in lines:
-        line = line.strip()
-        if not line: continue
+    def observe(self, line, context):
+        if "PAYMENT" in KOREA_MATCHER.match_types(line):
+            self._payment_amount(line, context)
+    
+    def handle(self, db: Session, writer, line, context):
+        current_sender, current_date = self.current_sender, self.current_date
         
-        match = header_pattern.match(line)
-        if match:
-            date_str, ampm, time_str, sender = match.groups()
-            current_sender = sender
-            try:
-                current_date = datetime.datetime.strptime(date_str, "%Y-%m-%d").date()
-            except: pass
-            continue
-
-        # Logic
-        if any(k in line for k in ["입금", "카드", "송금"]):
-            print(f"[KOREA] Payment Logic: {line}")
-            utils.add_interaction(
-                db, 
-                get_or_create_guest(db, current_sender).id, 
-                f"[입금확인] {line}", 
-                None, 
-                "완료", 
-                log_date=current_date
-            )
+        # Logic (all room keywords matched in one pass)
+        rules = KOREA_MATCHER.match_types(line)
+        if "PAYMENT" in rules:
+            amount, duplicate = self._payment_amount(line, context)
+            if duplicate:
+                print(f"[KOREA] Payment Duplicate (skipped): {line}")
+            else:
+                print(f"[KOREA] Payment Logic: {line}")
+                writer.add_interaction(
+                    get_or_create_guest(db, current_sender), 
+                    f"[입금확인] {line}", 
+                    None, 
+                    "완료", 
+                    log_date=current_date,
+                    amount=amount
+                )
             
-        if "발주서" in line or "견적서" in line:
+        if "DOCUMENT" in rules:
             # Enhanced Logic: Extract Company/Subject
             # Patterns to try
             company_name = "미상"
@@ -179,7 +296,7 @@ def process_korea_log(db: Session, text):
             # Exclusion: If name is too trivial (e.g. "네", "이번") skip or mark generic
             if len(company_name) < 2 or company_name in ["네", "네,", "이번", "혹시", "미상"]:
                 print(f"[KOREA] Order Form Logic IGNORED: {line} -> {company_name}")
-                continue
+                return
             
             # Filter matches only if "발주서" is clearly the main topic
             # (Already checked "발주서" in line)
@@ -193,9 +310,8 @@ def process_korea_log(db: Session, text):
             
             print(f"[KOREA] Doc Logic ({doc_type}): {line} -> {company_name}")
             
-            utils.create_order(
-                db, 
-                get_or_create_guest(db, current_sender).id, 
+            writer.create_order(
+                get_or_create_guest(db, current_sender), 
                 current_date, 
                 f"{label} {company_name}", 
                 1, 
@@ -203,11 +319,11 @@ def process_korea_log(db: Session, text):
                 f"원본: {line}"
             )
             
-        elif any(k in line for k in ["기업", "업체"]):
+        elif "ORDER" in rules:
             # Generic Order Logic
             # Filter out confirmations/questions
-            if any(n in line for n in ["확인", "네", "감사", "수고", "문의", "?"]):
-                continue
+            if "NOT_ORDER" in rules:
+                return
                 
             print(f"[KOREA] Order Logic: {line}")
             # Try to extract quantity or just save text
@@ -215,9 +331,8 @@ def process_korea_log(db: Session, text):
             nums = re.findall(r'\d+', line)
             if nums: qty = int(nums[0])
             
-            utils.create_order(
-                db, 
-                get_or_create_guest(db, current_sender).id, 
+            writer.create_order(
+                get_or_create_guest(db, current_sender), 
                 current_date, 
                 "국내발주(자동감지)", 
                 qty, 
@@ -225,10 +340,24 @@ def process_korea_log(db: Session, text):
                 f"원본: {line}"
             )
 
+def process_china_log(db: Session, lines):
+    """One-shot helper: a fresh ChinaRoomProcessor over lines."""
+    return ChinaRoomProcessor().process(db, lines)
+
+def process_korea_log(db: Session, lines):
+    """One-shot helper: a fresh KoreaRoomProcessor over lines."""
+    return KoreaRoomProcessor().process(db, lines)
+
+# Sender -> customer id (one preload query instead of one per line). Reloads when a
+# customer is renamed/deleted in the app (utils cache version); log_service keeps this
+# cache for days, so it also has a TTL like messenger_listener's.
+GUEST_CACHE_TTL = 300  # seconds
+GUEST_CACHE = utils.CustomerNameCache(ttl=GUEST_CACHE_TTL)
+
 def get_or_create_guest(db: Session, name):
-    # Find existing or create dummy customer
-    cust = db.query(Customer).filter((Customer.client_name == name) | (Customer.company_name == name)).first()
-    if not cust:
+    """Returns the customer id for a sender, creating a guest customer if needed."""
+    cust_id = GUEST_CACHE.get(db, name)
+    if cust_id is None:
         # Check if we have a generic 'Messenger Guest'
         cust = db.query(Customer).filter(Customer.company_name == f"Unknown-{name}").first()
         if not cust:
@@ -239,31 +368,158 @@ def get_or_create_guest(db: Session, name):
                  industry="메신저유입"
              )
              db.add(cust)
-             db.commit()
-             db.refresh(cust)
-    return cust
-
-def main():
-    print(f"--- Batch Process Started: {datetime.datetime.now()} ---")
-    state = load_state()
-    files = get_todays_filepaths()
-    db = next(get_db())
+             db.flush()  # assigns cust.id; committed with the file's rows
+        cust_id = cust.id
+        GUEST_CACHE.add(name, cust_id)
+    return cust_id
+
+def process_room(db: Session, filepath, state_key, legacy_state, processor):
+    """
+    Process the new lines of one room file as a single transaction that also stores
+    the file's offset. On error the rows and the offset roll back together, so the
+    next run re-reads exactly the same bytes.
+    processor: a new RoomProcessor for the room (seeded here from the log before the offset)
+    """
+    if not os.path.exists(filepath):
+        print(f"File not found: {filepath}")
+        return
+    start = get_start_offset(db, state_key, filepath, legacy_state)
+    # If file is smaller than last_pos, it might have been reset/rotated
+    if os.path.getsize(filepath) < start:
+        start = 0
     
-    # 1. Process China Room
-    print(f"Checking China Room: {files['CHINA']}")
-    china_text = read_new_content(files['CHINA'], "china_room", state)
-    if china_text:
-        process_china_log(db, china_text)
+    seed_processor(processor, filepath, start)
+    progress = {"pos": start}
+    try:
+        written = processor.process(db, read_new_lines(filepath, start, progress))
+        if progress["pos"] == start:
+            db.rollback()
+            return
+        print(f" -> {written} rows")
+        utils.set_log_checkpoint(db, checkpoint_source(state_key, filepath), progress["pos"])
+        db.commit()
+    except Exception:
+        db.rollback()
+        GUEST_CACHE.invalidate()  # may hold ids of guests that were rolled back
+        raise
+
+# --- Rooms & Catch-up ---
+# Rooms to import: state key -> (folder under BASE_DIR, RoomProcessor class). Add a room here.
+ROOMS = {
+    "china_room": (CHINA_ROOM, ChinaRoomProcessor),
+    "korea_room": (KOREA_ROOM, KoreaRoomProcessor),
+}
+
+def list_dated_files(room_dir, since):
+    """(date, path) of the day files in room_dir dated on/after since, oldest first."""
+    if not os.path.isdir(room_dir):
+        print(f"Room folder not found: {room_dir}")
+        return []
+    files = []
+    for name in os.listdir(room_dir):
+        match = DATED_FILE_PATTERN.match(name)
+        if not match:
+            continue
+        try:
+            file_date = datetime.date.fromisoformat(match.group(1))
+        except ValueError:
+            continue
+        if file_date >= since:
+            files.append((file_date, os.path.join(room_dir, name)))
+    return sorted(files)
+
+def find_pending_files(db: Session, room_keys, since, legacy_state):
+    """(state_key, path) for every day file with bytes past its checkpoint."""
+    pending = []
+    for state_key in room_keys:
+        room_dir = os.path.join(BASE_DIR, ROOMS[state_key][0])
+        for _, filepath in list_dated_files(room_dir, since):
+            start = get_start_offset(db, state_key, filepath, legacy_state)
+            if os.path.getsize(filepath) != start:
+                pending.append((state_key, filepath))
+    return pending
+
+def process_file_job(state_key, filepath, legacy_state):
+    """
+    Worker entry point: one file in its own session/transaction.
+    Returns an error message, or None on success (errors don't stop the other files).
+    """
+    processor_class = ROOMS[state_key][1]
+    delay = LOCK_RETRY_DELAY
+    guest_retried = False
+    for attempt in range(LOCK_RETRIES):
+        try:
+            with session_scope() as db:
+                process_room(db, filepath, state_key, legacy_state, processor_class())
+            return None
+        except IntegrityError as e:
+            # Two workers created the same guest customer; the retry finds the committed one
+            if guest_retried:
+                return str(e)
+            guest_retried = True
+        except OperationalError as e:
+            # Lock timeout/deadlock with another worker; the file rolled back as a whole
+            message = str(e.orig).lower()
+            if ("locked" not in message and "deadlock" not in message) or attempt == LOCK_RETRIES - 1:
+                return str(e)
+            print(f"Database busy, retrying {filepath} in {delay:.1f}s")
+            time.sleep(delay)
+            delay *= 2
+        except Exception as e:
+            return str(e)
+    return f"gave up after {LOCK_RETRIES} attempts"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import messenger room logs into the CRM")
+    # Today's last message is held back until the file is final, so the default window
+    # includes yesterday: a plain run completes the previous day's last message.
+    parser.add_argument("--catch-up", type=int, default=2, metavar="DAYS",
+                        help="process day files from the last DAYS days (default: 2 = yesterday and today)")
+    parser.add_argument("--rooms", default=",".join(ROOMS),
+                        help=f"comma-separated room keys (default: {','.join(ROOMS)})")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS,
+                        help="parallel file workers")
+    args = parser.parse_args(argv)
     
-    # 2. Process Korea Room
-    print(f"Checking Korea Room: {files['KOREA']}")
-    korea_text = read_new_content(files['KOREA'], "korea_room", state)
-    if korea_text:
-        process_korea_log(db, korea_text)
-        
-    save_state(state)
-    db.close()
-    print("--- Batch Process Completed ---")
+    room_keys = [k.strip() for k in args.rooms.split(",") if k.strip()]
+    unknown = [k for k in room_keys if k not in ROOMS]
+    if unknown:
+        parser.error(f"unknown room(s): {', '.join(unknown)}")
+    since = datetime.date.today() - datetime.timedelta(days=max(args.catch_up, 1) - 1)
+    
+    print(f"--- Batch Process Started: {datetime.datetime.now()} (since {since}) ---")
+    legacy_state = load_state()
+    init_db()
+    with session_scope() as db:
+        # Apply pending schema steps (new columns are written below)
+        for log in utils.run_db_migration(db):
+            print(log)
+        jobs = find_pending_files(db, room_keys, since, legacy_state)
+    
+    print(f"{len(jobs)} file(s) with new content")
+    failed = 0
+    if args.workers <= 1 or len(jobs) <= 1:
+        for state_key, filepath in jobs:
+            print(f"Checking {state_key}: {filepath}")
+            error = process_file_job(state_key, filepath, legacy_state)
+            if error:
+                failed += 1
+                print(f"Error processing {filepath}: {error}")
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = {
+                pool.submit(process_file_job, state_key, filepath, legacy_state): filepath
+                for state_key, filepath in jobs
+            }
+            for future in as_completed(futures):
+                error = future.result()
+                if error:
+                    failed += 1
+                    print(f"Error processing {futures[future]}: {error}")
+                else:
+                    print(f"Done: {futures[future]}")
+            
+    print(f"--- Batch Process Completed ({len(jobs) - failed}/{len(jobs)} files) ---")
 
 if __name__ == "__main__":
     main()
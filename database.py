@@ -1,24 +1,69 @@
-from sqlalchemy import create_engine
+import os
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 import streamlit as st
 
+def get_setting(name, default=None):
+    """
+    Read a config value: environment variable first, then Streamlit secrets, then default.
+    (batch_processor / messenger_listener run outside Streamlit, so env vars must work too.)
+    """
+    if name in os.environ:
+        return os.environ[name]
+    try:
+        if name in st.secrets:
+            return st.secrets[name]
+    except FileNotFoundError:
+        # Local run without secrets.toml
+        pass
+    return default
+
 # Check if running in Streamlit Cloud (Secrets available)
 # Logic: Use PostgreSQL if 'DATABASE_URL' is in secrets, else fallback to local SQLite
-try:
-    if "DATABASE_URL" in st.secrets:
-        DATABASE_URL = st.secrets["DATABASE_URL"]
-        # SQLAlchemy requires 'postgresql://', but some providers give 'postgres://'
-        if DATABASE_URL.startswith("postgres://"):
-            DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
-    else:
-        DATABASE_URL = "sqlite:///crm.db"
-except FileNotFoundError:
-    # Local run without secrets.toml
-    DATABASE_URL = "sqlite:///crm.db"
+DATABASE_URL = get_setting("DATABASE_URL", "sqlite:///crm.db")
+# SQLAlchemy requires 'postgresql://', but some providers give 'postgres://'
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+# Connection pool (secrets / env: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_RECYCLE, DB_POOL_TIMEOUT, DB_POOL_PRE_PING)
+# Defaults are sized for several concurrent Streamlit sessions on one server.
+POOL_SETTINGS = {
+    "pool_size": int(get_setting("DB_POOL_SIZE", 10)),
+    "max_overflow": int(get_setting("DB_MAX_OVERFLOW", 20)),
+    "pool_recycle": int(get_setting("DB_POOL_RECYCLE", 1800)),  # seconds; hosted PG drops idle connections
+    "pool_timeout": int(get_setting("DB_POOL_TIMEOUT", 30)),
+    "pool_pre_ping": str(get_setting("DB_POOL_PRE_PING", "true")).lower() in ("1", "true", "yes"),
+}
+
+# SQLite profile (secrets / env: SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE, SQLITE_CACHE_SIZE, SQLITE_BUSY_TIMEOUT_MS)
+# The app, messenger_listener and batch_processor share crm.db, so WAL lets readers
+# proceed while a writer commits, and busy_timeout waits instead of "database is locked".
+# Set a value to "" to leave that pragma at the SQLite default.
+SQLITE_PRAGMAS = {
+    "journal_mode": get_setting("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": get_setting("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": get_setting("SQLITE_MMAP_SIZE", 268435456),   # 256 MB
+    "cache_size": get_setting("SQLITE_CACHE_SIZE", -65536),    # negative = KiB (64 MB)
+    "busy_timeout": get_setting("SQLITE_BUSY_TIMEOUT_MS", 10000),
+}
 
 # Create engine
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **POOL_SETTINGS)
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine, "connect")
+    def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+        """Applied once per new DBAPI connection (pooled connections keep them)."""
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in SQLITE_PRAGMAS.items():
+                if value not in (None, ""):
+                    cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
 
 # Create session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -37,3 +82,20 @@ def get_db():
         yield db
     finally:
         db.close()
+
+@contextmanager
+def session_scope():
+    """
+    Session context manager: `with session_scope() as db: ...`
+    Rolls back on error and always closes, so the connection returns to the pool
+    deterministically (unlike `next(get_db())`, whose generator is never exhausted).
+    Callers still commit explicitly, as the utils functions already do.
+    """
+    db = SessionLocal()
+    try:
+        yield db
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
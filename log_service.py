@@ -0,0 +1,251 @@
+"""
+Near-real-time log ingestion service.
+
+One asyncio process that tails every room's day file (batch_processor.ROOMS, with
+that room's rules) and the messenger listener file at the same time:
+
+    python log_service.py [--rooms korea_room,china_room] [--no-listener]
+
+- Each source is followed by its own task; checking for new data costs one stat per
+  POLL_INTERVAL, and only appended bytes are read (message_rules.LogTail).
+- All DB work runs on a single writer thread with pooled connections: every batch
+  of messages is one transaction that also stores the file's checkpoint, so the
+  service, batch_processor and messenger_listener share log_checkpoints and a
+  restart resumes where the last commit ended.
+- Room day files switch at midnight; the previous day's file is finished first.
+- On start, earlier days' room files with unread bytes (the service was down over
+  midnight) are imported first, like batch_processor --catch-up.
+
+Runs instead of the scheduled batch job and messenger_listener.py (don't run them
+at the same time on the same files).
+"""
+import os
+import time
+import asyncio
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from database import session_scope, init_db
+from message_rules import LogTail
+import batch_processor
+import messenger_listener
+import utils
+
+POLL_INTERVAL = 1             # seconds between stat() checks per source
+SETTLE_SECONDS = 2            # newest message is complete once its file is unchanged this long
+MAX_BATCH_MESSAGES = 500      # messages per transaction
+CATCH_UP_DAYS = 7             # days of room files checked for unread bytes on start
+
+class Source:
+    """
+    One followed log.
+    path_for(date) -> file to follow on that day
+    checkpoint_for(path) -> log_checkpoints key
+    apply(db, messages) -> stages the rows for a list of messages (lines)
+    start_at_end: first run without a checkpoint skips existing content (listener file)
+    prepare(path, pos) -> optional; rebuilds the state apply() carries between batches
+        when a file is opened at pos, or rewound to pos after an error
+    """
+    def __init__(self, name, path_for, checkpoint_for, apply, start_at_end=False, prepare=None):
+        self.name = name
+        self.path_for = path_for
+        self.checkpoint_for = checkpoint_for
+        self.apply = apply
+        self.start_at_end = start_at_end
+        self.prepare = prepare
+
+def room_source(state_key):
+    room_dir, processor_class = batch_processor.ROOMS[state_key]
+    # One RoomProcessor per room, so the current sender, amount lookback and payment
+    # de-dup carry across polls (most polls hold a single message)
+    processor = None
+
+    def prepare(path, pos):
+        nonlocal processor
+        processor = processor_class()
+        batch_processor.seed_processor(processor, path, pos)
+
+    def apply(db, messages):
+        return processor.process(db, (line for lines in messages for line in lines))
+
+    return Source(
+        state_key,
+        path_for=lambda day: os.path.join(batch_processor.BASE_DIR, room_dir, f"{day.isoformat()}.txt"),
+        checkpoint_for=lambda path: batch_processor.checkpoint_source(state_key, path),
+        apply=apply,
+        prepare=prepare,
+    )
+
+def listener_source(filename):
+    return Source(
+        "listener",
+        path_for=lambda day: filename,
+        checkpoint_for=lambda path: f"listener:{os.path.abspath(path)}",
+        apply=messenger_listener.apply_messages,
+        start_at_end=True,
+    )
+
+# --- DB Writer (single thread) ---
+class DBWriter:
+    """Runs all DB work in order on one thread; sessions come from the engine's pool."""
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="crm-writer")
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def resume(source, path):
+    with session_scope() as db:
+        first_run_pos = os.path.getsize(path) if source.start_at_end else 0
+        start = utils.resume_log_offset(db, source.checkpoint_for(path), path, first_run_pos)
+    if source.prepare:
+        source.prepare(path, start)
+    return start
+
+def ingest(source, path, tail, final):
+    """
+    (writer thread) Applies the messages completed by the appended bytes,
+    MAX_BATCH_MESSAGES per transaction, each committed with its end offset.
+    On error the tail is rewound to the last commit, so the bytes are read again, and the
+    source's state is rebuilt (it already saw the rolled-back messages).
+    Returns the number of messages committed, or None after an error.
+    """
+    committed = tail.committed_pos
+    done = 0
+    batch, end = [], None
+    try:
+        with session_scope() as db:
+            for lines, end in tail.poll(final=final):
+                batch.append(lines)
+                if len(batch) >= MAX_BATCH_MESSAGES:
+                    _commit_batch(db, source, path, tail, batch, end)
+                    committed, done, batch = end, done + len(batch), []
+            if batch:
+                _commit_batch(db, source, path, tail, batch, end)
+                committed, done = end, done + len(batch)
+    except Exception as e:
+        print(f"[{source.name}] Error ingesting {path}: {e}")
+        batch_processor.GUEST_CACHE.invalidate()  # may hold ids of guests that were rolled back
+        tail.reset(committed)
+        if source.prepare:
+            source.prepare(path, committed)
+        return None
+    return done
+
+def _commit_batch(db, source, path, tail, batch, end):
+    source.apply(db, batch)
+    utils.save_log_offset(db, source.checkpoint_for(path), path, end, file_id=tail.file_id)
+    db.commit()
+
+# --- Followers ---
+def report(source, done):
+    if done:
+        print(f"[{datetime.datetime.now().strftime('%H:%M:%S')}] [{source.name}] Committed {done} message(s)")
+
+async def follow(source, writer, stop):
+    """Follows source.path_for(today); finishes the old file when the day changes."""
+    path, tail = None, None
+    last_size, last_change = None, time.monotonic()
+
+    while not stop.is_set():
+        today_path = source.path_for(datetime.date.today())
+        if today_path != path and tail is not None:
+            # Day rolled over: the previous file is complete. It stays current until its
+            # final batch commits (after an error the tail was rewound: retry next tick).
+            done = await writer.run(ingest, source, path, tail, True)
+            if done is not None:
+                report(source, done)
+                tail = None
+        if today_path != path and tail is None:
+            path, last_size = today_path, None
+
+        if path == today_path and tail is None and os.path.exists(path):
+            tail = LogTail(path, start=await writer.run(resume, source, path))
+            print(f"[{source.name}] Following {path} from byte {tail.read_pos}")
+
+        if path == today_path and tail is not None and os.path.exists(path):
+            size = os.path.getsize(path)
+            now = time.monotonic()
+            if size != last_size:
+                last_size, last_change = size, now
+                done = await writer.run(ingest, source, path, tail, False)
+            elif tail.has_pending and now - last_change >= SETTLE_SECONDS:
+                done = await writer.run(ingest, source, path, tail, True)
+            else:
+                done = 0
+            if done is None:
+                last_size = None  # rewound after an error: retry on the next tick
+            else:
+                report(source, done)
+
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+def catch_up(room_keys, days):
+    """
+    Imports the earlier days' room files that still have unread bytes, one transaction
+    per file as in batch_processor. Today's files are left to the followers.
+    """
+    today = datetime.date.today()
+    since = today - datetime.timedelta(days=max(days, 1) - 1)
+    legacy_state = batch_processor.load_state()
+    with session_scope() as db:
+        jobs = batch_processor.find_pending_files(db, room_keys, since, legacy_state)
+
+    for state_key, filepath in jobs:
+        if os.path.basename(filepath)[:10] >= today.isoformat():
+            continue
+        print(f"[{state_key}] Catching up {filepath}")
+        error = batch_processor.process_file_job(state_key, filepath, legacy_state)
+        if error:
+            print(f"[{state_key}] Error processing {filepath}: {error}")
+
+async def serve(sources):
+    writer = DBWriter()
+    stop = asyncio.Event()
+    try:
+        await asyncio.gather(*(follow(source, writer, stop) for source in sources))
+    finally:
+        stop.set()
+        writer.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tail messenger room logs into the CRM")
+    parser.add_argument("--rooms", default=",".join(batch_processor.ROOMS),
+                        help=f"comma-separated room keys (default: {','.join(batch_processor.ROOMS)})")
+    parser.add_argument("--listener-file", default=messenger_listener.WATCH_FILE,
+                        help="messenger listener log to follow as well")
+    parser.add_argument("--no-listener", action="store_true", help="only follow the room files")
+    parser.add_argument("--catch-up", type=int, default=CATCH_UP_DAYS, metavar="DAYS",
+                        help=f"on start, first import unread room files from the last DAYS days (default: {CATCH_UP_DAYS})")
+    args = parser.parse_args(argv)
+
+    room_keys = [k.strip() for k in args.rooms.split(",") if k.strip()]
+    unknown = [k for k in room_keys if k not in batch_processor.ROOMS]
+    if unknown:
+        parser.error(f"unknown room(s): {', '.join(unknown)}")
+
+    sources = [room_source(k) for k in room_keys]
+    if not args.no_listener:
+        sources.append(listener_source(args.listener_file))
+
+    init_db()
+    with session_scope() as db:
+        for log in utils.run_db_migration(db):
+            print(log)
+    catch_up(room_keys, args.catch_up)
+
+    print(f"--- Log Service Started: {', '.join(s.name for s in sources)} (Ctrl+C to stop) ---")
+    try:
+        asyncio.run(serve(sources))
+    except KeyboardInterrupt:
+        print("--- Log Service Stopped ---")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+Shared messenger parsing helpers.
+
+- HEADER_PATTERN / parse_header: the chat header line "[YYYY-MM-DD 오후 2:44] 이름"
+- RuleMatcher: compiles a rule list (MESSENGER_RULES, RULES, room rules) into one
+  regex and classifies a message in a single pass over the text.
+- iter_messages / LogTail: stream complete messages from a growing log file.
+"""
+import re
+import os
+import codecs
+import hashlib
+from datetime import datetime
+
+# Regex for Korean KakaoTalk/Messenger style: [YYYY-MM-DD 오후 2:44] 이름
+HEADER_PATTERN = re.compile(r"^\[(\d{4}-\d{2}-\d{2}) (오전|오후) (\d{1,2}:\d{2})\] (.*)")
+
+def parse_header(line):
+    """
+    Returns (datetime, sender) if line is a message header, else None.
+    An invalid date/time falls back to datetime.now() (same as the old inline parsers).
+    """
+    match = HEADER_PATTERN.match(line)
+    if not match:
+        return None
+
+    date_str, ampm, time_str, sender = match.groups()
+    hour, minute = map(int, time_str.split(':'))
+    if ampm == "오후" and hour != 12: hour += 12
+    elif ampm == "오전" and hour == 12: hour = 0
+
+    try:
+        dt = datetime.strptime(f"{date_str} {hour:02d}:{minute:02d}:00", "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        dt = datetime.now()
+    return dt, sender.strip()
+
+class RuleMatcher:
+    """
+    Multi-keyword matcher for rule lists of the form
+        [{"type": "ORDER", "keywords": ["발주", "주문"], ...}, ...]
+
+    All keywords are compiled into one alternation inside a lookahead, so a single
+    regex scan reports the longest keyword starting at every position. Shorter
+    keywords hidden inside a longer match are covered by a precomputed substring
+    closure, so the result equals checking every keyword with `in`.
+
+    Priority: a rule's optional "priority" value (lower wins), else its list order.
+    Matching is case-sensitive, like the `k in text` checks it replaces.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        order = sorted(range(len(rules)), key=lambda i: (rules[i].get("priority", i), i))
+        self._rank = {}
+        for rank, i in enumerate(order):
+            self._rank.setdefault(rules[i]["type"], rank)
+
+        owners = {}  # keyword -> rule types using it
+        for rule in rules:
+            for k in rule["keywords"]:
+                if k:
+                    owners.setdefault(k, set()).add(rule["type"])
+
+        # keyword -> types of every keyword contained in it (incl. itself)
+        self._types_for = {
+            k: frozenset().union(*(types for other, types in owners.items() if other in k))
+            for k in owners
+        }
+
+        if owners:
+            alternation = "|".join(re.escape(k) for k in sorted(owners, key=len, reverse=True))
+            self._pattern = re.compile(f"(?=({alternation}))")
+        else:
+            self._pattern = None
+
+    def match_types(self, text):
+        """Set of rule types whose keywords occur in text."""
+        found = set()
+        if not text or self._pattern is None:
+            return found
+        for m in self._pattern.finditer(text):
+            found |= self._types_for[m.group(1)]
+            if len(found) == len(self._rank):
+                break
+        return found
+
+    def classify(self, text):
+        """Highest-priority matching rule type, or None."""
+        found = self.match_types(text)
+        if not found:
+            return None
+        return min(found, key=self._rank.__getitem__)
+
+def iter_messages(f, start=0, final=False, decode=None):
+    """
+    Streams complete messages from a binary log file opened with open(path, "rb").
+    Yields (lines, end_offset): the stripped non-empty lines of one message (header
+    first, then continuation lines) and the byte offset just after it.
+    
+    Reads line by line from `start`, so memory stays at one message regardless of
+    file size. The last message is only complete once the next header arrives: it is
+    held back (its end_offset is never yielded) unless final=True, so a caller that
+    resumes from the last end_offset re-reads it whole on the next poll.
+    A line without its newline yet is never consumed.
+    
+    decode: bytes -> str (default UTF-8, undecodable bytes dropped).
+    """
+    if decode is None:
+        decode = lambda raw: raw.decode("utf-8", errors="ignore")
+    
+    f.seek(start)
+    pos = start
+    message, message_end = [], start
+    for raw in f:
+        if not raw.endswith(b"\n") and not final:
+            break  # still being written
+        pos += len(raw)
+        line = decode(raw).strip()
+        if not line:
+            continue
+        if message and HEADER_PATTERN.match(line):
+            yield message, message_end
+            message = []
+        message.append(line)
+        message_end = pos
+    
+    if message and final:
+        yield message, message_end
+
+def detect_encoding(sample):
+    """Messenger exports are UTF-8 (optionally with BOM) or CP949 (Korean Windows)."""
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    try:
+        # Incremental, so a sample cut in the middle of a character still counts as UTF-8
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp949"
+
+# Bytes hashed from the start of a log file to recognise it after a restart
+HEAD_HASH_BYTES = 1024
+
+def file_identity(stat):
+    """'dev:inode' from an os.stat() result, or None where the platform reports no inode."""
+    return f"{stat.st_dev}:{stat.st_ino}" if stat.st_ino else None
+
+def head_hash(path, length):
+    """sha1 of the first min(length, HEAD_HASH_BYTES) bytes (catches a file replaced in place)."""
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read(min(length, HEAD_HASH_BYTES))).hexdigest()
+
+class LogTail:
+    """
+    Follows one growing log file for a long-running listener.
+    
+    poll() does a single read of the bytes appended since the previous poll and
+    yields the messages they complete, like iter_messages, but the unfinished newest
+    message and any partial line stay in memory instead of being re-read next time.
+    The encoding is detected once per file (again after a truncation/rotation) and
+    decoded with a stateful incremental decoder; all offsets are real byte offsets.
+    
+    committed_pos: byte offset after the last message the caller finished handling.
+    file_id: identity of the file being read (see file_identity); a change means the
+    path now points to a new file, which is then read from the start.
+    """
+    READ_SIZE = 1 << 20
+
+    def __init__(self, path, start=0, encoding=None):
+        self.path = path
+        self.default_encoding = encoding  # None = detect from the first bytes read
+        self.reset(start)
+
+    def reset(self, start=0):
+        self.read_pos = start       # bytes read from the file so far
+        self.committed_pos = start
+        self.encoding = self.default_encoding
+        self.file_id = None
+        self._decoder = None
+        self._partial = b""         # bytes after the last newline
+        self._message = []          # lines of the newest (possibly unfinished) message
+        self._message_end = start
+
+    @property
+    def has_pending(self):
+        return bool(self._message or self._partial)
+
+    def poll(self, final=False):
+        """
+        Yields (lines, end_offset) for each message completed by the new bytes.
+        final=True also completes the newest message (and a line without newline).
+        """
+        stat = os.stat(self.path)
+        size = stat.st_size
+        file_id = file_identity(stat)
+        if size < self.read_pos or (self.file_id and file_id and file_id != self.file_id):
+            # File was reset/rotated: start over (and re-detect its encoding)
+            self.reset(0)
+        self.file_id = file_id
+
+        with open(self.path, "rb") as f:
+            f.seek(self.read_pos)
+            while self.read_pos < size:
+                data = f.read(min(self.READ_SIZE, size - self.read_pos))
+                if not data:
+                    break
+                self.read_pos += len(data)
+                yield from self._feed(self._partial + data, final=False)
+
+        if final:
+            yield from self._feed(self._partial, final=True)
+
+    def _feed(self, buf, final):
+        cut = len(buf) if final else buf.rfind(b"\n") + 1
+        complete, self._partial = buf[:cut], buf[cut:]
+        if not complete and not final:
+            return
+
+        if self._decoder is None and complete:
+            if self.encoding is None:
+                self.encoding = detect_encoding(complete)
+            self._decoder = codecs.getincrementaldecoder(self.encoding)(errors="replace")
+
+        # Byte offset where `complete` starts in the file
+        pos = self.read_pos - len(self._partial) - len(complete)
+        start = 0
+        while start < len(complete):
+            newline = complete.find(b"\n", start)
+            stop = len(complete) if newline < 0 else newline + 1
+            raw = complete[start:stop]
+            start = stop
+            pos += len(raw)
+
+            line = self._decoder.decode(raw).strip()
+            if not line:
+                continue
+            if self._message and HEADER_PATTERN.match(line):
+                message, end = self._message, self._message_end
+                self._message = []
+                yield message, end
+                self.committed_pos = end
+            self._message.append(line)
+            self._message_end = pos
+
+        if final and self._message:
+            message, end = self._message, self._message_end
+            self._message = []
+            yield message, end
+            self.committed_pos = end
@@ -1,209 +1,268 @@
 import time
-import re
 import os
+import re
+import queue
+import threading
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from datetime import datetime
-from database import get_db
-from models import Customer, Order, Interaction
+from database import SessionLocal, init_db
+from models import Order, Interaction
 import utils
+from message_rules import parse_header, RuleMatcher, LogTail
 
 # Configuration
 WATCH_FILE = "messenger_log.txt"
 POLL_INTERVAL = 1
+# The newest message is held until the next header arrives, or until the file has
+# not changed for this long (then it is treated as complete)
+MESSAGE_SETTLE_SECONDS = 1
+# Events closer together than this are coalesced into one read (watchdog fires several per write)
+DEBOUNCE_SECONDS = 0.2
+MAX_DEBOUNCE_SECONDS = 2    # upper bound on the delay while events keep arriving
+MAX_BATCH_MESSAGES = 500    # messages per transaction
+CUSTOMER_CACHE_TTL = 300  # seconds; full reload as a backstop to the cache version check
+
+# Sender -> customer id (reloads when customers are renamed/deleted in the app)
+CUSTOMER_CACHE = utils.CustomerNameCache(ttl=CUSTOMER_CACHE_TTL)
+
+# --- Message Actions ---
+def message_from_lines(lines):
+    """{'date', 'sender', 'text'} for one message's lines, or None without a header."""
+    header = parse_header(lines[0])
+    if not header:
+        print(f"DEBUG: Line ignored (No header yet): {lines[0][:20]}...")
+        return None
+
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] DEBUG: Header matched -> {lines[0][:30]}...") # Debug print
+    dt, sender = header
+    return {"date": dt, "sender": sender, "text": "\n".join(lines[1:])}
+
+def act_on_message(db, msg):
+    """Stages the CRM action for one message in db; the caller commits."""
+    sender = msg['sender']
+    text = msg['text'].strip()
+    timestamp = msg['date']
+
+    print(f"New Message from {sender}: {text[:30]}...")
+
+    # 1. Identify Customer
+    customer_id = CUSTOMER_CACHE.get(db, sender)
+
+    if customer_id is None:
+        print(f" -> Unknown customer: {sender} (Skip)")
+        return
+
+    # 2. Analyze & Execute Action
+    action_type = analyze_text(text)
+
+    if action_type == "ORDER":
+        # Extract Quantity (Context: numbers in text)
+        numbers = re.findall(r'\d+', text)
+        qty = int(numbers[0]) if numbers else 1
+
+        # Create Order
+        db.add(Order(**utils.order_row(
+            customer_id, 
+            timestamp.date(), 
+            "메신저 발주품", # Product Name (Generic)
+            qty, 
+            0, 
+            0, 
+            f"원본: {text}"
+        )))
+        print(f" -> [ACTION] Created Order (Qty: {qty})")
+
+    elif action_type == "INQUIRY":
+        status = "접촉중"
+        db.add(Interaction(**utils.interaction_row(
+            customer_id,
+            f"[메신저 문의] {text}",
+            None,
+            status,
+            log_date=timestamp.date()
+        )))
+        print(f" -> [ACTION] Logged Inquiry")
+
+    elif action_type == "COMPLETE":
+        # Update latest interaction (including ones staged earlier in this batch)
+        db.flush()
+        last_interaction = db.query(Interaction).filter(Interaction.customer_id == customer_id).order_by(Interaction.id.desc()).first()
+        if last_interaction:
+            last_interaction.status = "완료"
+            print(f" -> [ACTION] Updated Status to Complete")
+    else:
+        print(" -> No actionable keywords found.")
+
+def apply_messages(db, messages):
+    """Acts on (lines) messages from a LogTail/iter_messages; used by log_service too."""
+    for lines in messages:
+        msg = message_from_lines(lines)
+        if msg:
+            act_on_message(db, msg)
+
+_FLUSH = "flush"  # work item: also complete the trailing message
+_STOP = None
 
 class MessengerHandler(FileSystemEventHandler):
+    """
+    watchdog callbacks only enqueue a wake-up. One worker thread (start()/stop())
+    owns the LogTail and one DB session: it coalesces events arriving within
+    DEBOUNCE_SECONDS, reads the appended bytes once and applies all completed
+    messages in a single transaction, together with the file's checkpoint
+    (log_checkpoints), so a restart resumes exactly after the last applied message.
+    """
     def __init__(self, filename):
         self.filename = filename
-        self.last_pos = 0
-        # Try to start at the end of file to avoid re-processing old logs on restart
-        if os.path.exists(filename):
-            self.last_pos = os.path.getsize(filename)
-        
-        # Regex for Korean KakaoTalk/Messenger style: [YYYY-MM-DD 오후 2:44] 이름
-        self.header_pattern = re.compile(r"^\[(\d{4}-\d{2}-\d{2}) (오전|오후) (\d{1,2}:\d{2})\] (.*)")
+        self.last_change = None
+        self.events = queue.Queue()
+        self.worker = threading.Thread(target=self.run, name="crm-writer", daemon=True)
+        self.source = f"listener:{os.path.abspath(filename)}"
+        # Byte-offset reader; encoding (UTF-8 / CP949) is detected once per file.
+        # The start offset is set by run() from the saved checkpoint.
+        self.tail = LogTail(filename)
+
+    def start(self):
+        self.worker.start()
+
+    def stop(self):
+        self.events.put(_STOP)
+        self.worker.join()
 
     def on_modified(self, event):
         if not event.is_directory and event.src_path.endswith(self.filename):
-            self.process_new_lines()
+            self.last_change = time.monotonic()
+            self.events.put(event.src_path)
+
+    def flush_pending(self):
+        """Called every poll: act on a trailing message once the file has settled."""
+        if self.last_change is None or time.monotonic() - self.last_change < MESSAGE_SETTLE_SECONDS:
+            return
+        self.last_change = None
+        self.events.put(_FLUSH)
+
+    def run(self):
+        db = SessionLocal()
+        try:
+            self.tail.reset(self.resume_offset(db))
+            db.commit()
+            # Catch up on anything written while the listener was down
+            self.process_new_lines(db)
+            if self.tail.has_pending:
+                self.last_change = time.monotonic()  # flush_pending completes it once settled
+            while True:
+                item = self.events.get()
+                if item is _STOP:
+                    break
+                final, stopping = self.coalesce(item == _FLUSH)
+                self.process_new_lines(db, final=final)
+                if stopping:
+                    break
+        finally:
+            db.close()
+
+    def resume_offset(self, db):
+        """Saved offset if the file is unchanged, else 0; the current end on the first run."""
+        if not os.path.exists(self.filename):
+            return 0
+        return utils.resume_log_offset(db, self.source, self.filename, first_run_pos=os.path.getsize(self.filename))
+
+    def save_checkpoint(self, db, end):
+        """Stage the offset in the current transaction (committed with the batch's rows)."""
+        utils.save_log_offset(db, self.source, self.filename, end, file_id=self.tail.file_id)
+
+    def coalesce(self, final):
+        """Absorb queued events until DEBOUNCE_SECONDS pass without one. Returns (final, stopping)."""
+        deadline = time.monotonic() + MAX_DEBOUNCE_SECONDS
+        while time.monotonic() < deadline:
+            try:
+                item = self.events.get(timeout=DEBOUNCE_SECONDS)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                return final, True
+            final = final or item == _FLUSH
+        return final, False
 
-    def process_new_lines(self):
+    def process_new_lines(self, db, final=False):
+        """
+        Reads only the bytes appended since the last read and acts on the messages
+        they complete, MAX_BATCH_MESSAGES per transaction. The newest message is kept
+        by self.tail until the next header or a flush, so continuation lines are
+        never split from their header.
+        """
         if not os.path.exists(self.filename):
             return
 
+        batch = []  # (message or None, end offset)
         try:
-            # Try UTF-8 first, then CP949 (common on Windows)
-            encodings = ['utf-8', 'cp949']
-            content = ""
-            current_encoding = 'utf-8'
-            
-            for enc in encodings:
-                try:
-                    with open(self.filename, 'r', encoding=enc) as f:
-                        f.seek(self.last_pos)
-                        content = f.read()
-                        self.last_pos = f.tell() # Update pos only if read succeeds
-                        current_encoding = enc
-                        break
-                except UnicodeDecodeError:
-                    continue
-            
-            if content:
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] Detected change ({len(content)} chars, {current_encoding}). Parsing...")
-                self.parse_and_act(content)
-                
+            for lines, end in self.tail.poll(final=final):
+                batch.append((message_from_lines(lines), end))
+                if len(batch) >= MAX_BATCH_MESSAGES:
+                    self.apply_batch(db, batch)
+                    batch = []
         except Exception as e:
             print(f"Error reading file: {e}")
+        self.apply_batch(db, batch)
 
-    def parse_and_act(self, content):
-        lines = content.splitlines()
-        print(f"DEBUG: Processing {len(lines)} new lines...") # Debug print
-        
-        current_msg = {"date": None, "sender": None, "text": ""}
-        
-        for line in lines:
-            line = line.strip()
-            if not line: continue
-            
-            match = self.header_pattern.match(line)
-            if match:
-                print(f"DEBUG: Header matched -> {line[:30]}...") # Debug print
-                # Process previous message
-                if current_msg["sender"]:
-                    self.trigger_crm_action(current_msg)
-                
-                # Start new message
-                date_str, ampm, time_str, sender = match.groups()
-                
-                # ... (Time parsing logic) ...
-                hour, minute = map(int, time_str.split(':'))
-                if ampm == "오후" and hour != 12: hour += 12
-                elif ampm == "오전" and hour == 12: hour = 0
-                
-                try:
-                    dt = datetime.strptime(f"{date_str} {hour:02d}:{minute:02d}:00", "%Y-%m-%d %H:%M:%S")
-                except:
-                    dt = datetime.now()
-
-                current_msg = {"date": dt, "sender": sender.strip(), "text": ""}
-            else:
-                # Continuation
-                if current_msg["sender"]:
-                    current_msg["text"] += "\n" + line
-                else:
-                     print(f"DEBUG: Line ignored (No header yet): {line[:20]}...")
-        
-        # Process last message
-        if current_msg["sender"]:
-            self.trigger_crm_action(current_msg)
-
-    def trigger_crm_action(self, msg):
-        sender = msg['sender']
-        text = msg['text'].strip()
-        timestamp = msg['date']
-        
-        print(f"New Message from {sender}: {text[:30]}...")
-        
-        db = next(get_db())
+    def apply_batch(self, db, batch):
+        """One commit for the whole batch and its offset; if it fails, replay message by message."""
+        if not batch:
+            return
+        messages = [msg for msg, _ in batch if msg]
         try:
-            # 1. Identify Customer
-            customer = db.query(Customer).filter(
-                (Customer.client_name == sender) | (Customer.company_name == sender)
-            ).first()
-            
-            if not customer:
-                print(f" -> Unknown customer: {sender} (Skip)")
-                return
-
-            # 2. Analyze & Execute Action
-            action_type = analyze_text(text)
-            
-            if action_type == "ORDER":
-                # Extract Quantity (Context: numbers in text)
-                import re
-                numbers = re.findall(r'\d+', text)
-                qty = int(numbers[0]) if numbers else 1
-                
-                # Create Order
-                utils.create_order(
-                    db, 
-                    customer.id, 
-                    timestamp.date(), 
-                    "메신저 발주품", # Product Name (Generic)
-                    qty, 
-                    0, 
-                    0, 
-                    f"원본: {text}"
-                )
-                print(f" -> [ACTION] Created Order (Qty: {qty})")
-
-            elif action_type == "INQUIRY":
-                status = "접촉중"
-                utils.add_interaction(
-                    db,
-                    customer.id,
-                    f"[메신저 문의] {text}",
-                    None,
-                    status,
-                    log_date=timestamp.date()
-                )
-                print(f" -> [ACTION] Logged Inquiry")
-
-            elif action_type == "COMPLETE":
-                # Update latest interaction
-                last_interaction = db.query(Interaction).filter(Interaction.customer_id == customer.id).order_by(Interaction.id.desc()).first()
-                if last_interaction:
-                    last_interaction.status = "완료"
-                    db.commit()
-                    print(f" -> [ACTION] Updated Status to Complete")
-            else:
-                print(" -> No actionable keywords found.")
-            
+            for msg in messages:
+                act_on_message(db, msg)
+            self.save_checkpoint(db, batch[-1][1])
+            db.commit()
+            print(f"[{datetime.now().strftime('%H:%M:%S')}] Committed {len(messages)} message(s)")
         except Exception as e:
-            print(f"Error acting on message: {e}")
-        finally:
-            db.close()
+            db.rollback()
+            print(f"Batch failed ({e}), retrying one by one...")
+            for msg, end in batch:
+                try:
+                    if msg:
+                        act_on_message(db, msg)
+                    self.save_checkpoint(db, end)
+                    db.commit()
+                except Exception as e:
+                    # Skipped (logged); the next message's checkpoint moves past it
+                    db.rollback()
+                    print(f"Error acting on message: {e}")
 
 # --- CONFIGURATION & RULES ---
 # 여기에 규칙을 정의합니다. (규칙 추가/수정이 쉽도록 분리함)
+# priority: 여러 규칙이 동시에 걸리면 숫자가 작은 규칙이 선택됩니다.
 RULES = [
     {
         "type": "ORDER",
         "keywords": ["발주", "주문"],
+        "priority": 1,
         "description": "상품 주문으로 분류"
     },
     {
         "type": "INQUIRY",
         "keywords": ["문의", "?", "가능할까요", "언제"],
+        "priority": 3,
         "description": "일반 문의로 분류"
     },
     {
         "type": "COMPLETE",
         "keywords": ["완료", "감사합니다", "확정"],
+        "priority": 2,
         "description": "상담 완료 처리"
     }
 ]
 
+RULE_MATCHER = RuleMatcher(RULES)
+
 def analyze_text(text):
     """
     텍스트를 분석하여 가장 적합한 규칙을 찾습니다.
     (앞뒤 문맥을 고려한 로직 확장이 가능한 곳)
+    Order(1) > Complete(2) > Inquiry(3), resolved by RULE_MATCHER in one pass.
     """
-    text_lower = text.lower() # Case insensitive
-    
-    # 1. Check for Order (Priority 1)
-    if any(k in text for k in RULES[0]['keywords']):
-        return "ORDER"
-        
-    # 2. Check for Complete (Priority 2)
-    if any(k in text for k in RULES[2]['keywords']):
-        return "COMPLETE"
-        
-    # 3. Check for Inquiry (Priority 3)
-    if any(k in text for k in RULES[1]['keywords']):
-        return "INQUIRY"
-        
-    return None
+    return RULE_MATCHER.classify(text)
 
 
 
@@ -212,8 +271,15 @@ if __name__ == "__main__":
     if not os.path.exists(WATCH_FILE):
         with open(WATCH_FILE, 'w', encoding='utf-8') as f:
             f.write("")
+    
+    # Make sure the schema is current before writing interactions/orders
+    init_db()
+    with SessionLocal() as db:
+        for log in utils.run_db_migration(db):
+            print(log)
             
     event_handler = MessengerHandler(WATCH_FILE)
+    event_handler.start()
     observer = Observer()
     observer.schedule(event_handler, path=".", recursive=False)
     observer.start()
@@ -224,6 +290,8 @@ if __name__ == "__main__":
     try:
         while True:
             time.sleep(POLL_INTERVAL)
+            event_handler.flush_pending()
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    event_handler.stop()
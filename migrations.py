@@ -0,0 +1,186 @@
+"""
+Versioned schema migrations.
+
+Every step runs at most once per database. Applied steps are recorded in the
+'schema_version' table, so a normal app start costs a single MAX(version)
+query and only pending steps touch the schema.
+
+Steps must be safe on databases that were already patched by the old
+try/except ALTER TABLE loop (or created fresh by create_all), so each one
+checks the live schema before changing it.
+"""
+from sqlalchemy import inspect, text, func
+from sqlalchemy.orm import Session
+from models import SchemaVersion, LogCheckpoint, AIResponseCache, AICacheCounter, CacheVersion, Customer, Order, Interaction, Quote
+
+# --- Helpers ---
+def _existing_columns(db: Session, table: str):
+    return {c["name"] for c in inspect(db.connection()).get_columns(table)}
+
+def _add_columns(db: Session, table: str, columns: list):
+    """Add (column_name, ddl_type) pairs that are missing from table."""
+    logs = []
+    existing = _existing_columns(db, table)
+    for col, dtype in columns:
+        if col in existing:
+            continue
+        db.execute(text(f"ALTER TABLE {table} ADD COLUMN {col} {dtype}"))
+        logs.append(f"✅ {table}: Added '{col}'")
+    return logs
+
+def _create_missing_indexes(db: Session, model, names: list):
+    """
+    create_all() only indexes new tables, so existing DBs get model indexes here.
+    Index names are listed per step so a step never depends on columns added later.
+    """
+    logs = []
+    conn = db.connection()
+    table = model.__table__
+    existing = {ix["name"] for ix in inspect(conn).get_indexes(table.name)}
+    for index in table.indexes:
+        if index.name not in names or index.name in existing:
+            continue
+        index.create(bind=conn, checkfirst=True)
+        logs.append(f"✅ {table.name}: Created index '{index.name}'")
+    return logs
+
+# --- Steps ---
+def _v1_quote_item_specs(db: Session):
+    # Detailed specs from AI/User (formerly migrate_db.py)
+    return _add_columns(db, "quote_items", [
+        ("print_type", "VARCHAR"),
+        ("origin", "VARCHAR"),
+        ("color", "VARCHAR"),
+        ("cutting", "BOOLEAN DEFAULT FALSE"),
+        ("remote_control", "BOOLEAN DEFAULT FALSE"),
+        ("due_date", "VARCHAR"),
+        ("note", "VARCHAR"),
+        ("selected_options", "VARCHAR"),
+    ])
+
+def _v2_customer_email(db: Session):
+    return _add_columns(db, "customers", [("email", "VARCHAR")])
+
+def _v3_interaction_category_summary(db: Session):
+    return _add_columns(db, "interactions", [("category", "VARCHAR"), ("summary", "VARCHAR")])
+
+def _v4_hot_filter_indexes(db: Session):
+    logs = _create_missing_indexes(db, Order, ["ix_orders_customer_id_order_date", "ix_orders_order_date"])
+    logs += _create_missing_indexes(db, Interaction, [
+        "ix_interactions_customer_id_log_date",
+        "ix_interactions_log_date",
+        "ix_interactions_next_action_date_status",
+    ])
+    logs += _create_missing_indexes(db, Quote, ["ix_quotes_customer_id_quote_date"])
+    return logs
+
+def _v5_interaction_kind(db: Session):
+    # Persisted tag classification (see utils.INTERACTION_KIND_TAGS), backfilled from content
+    from utils import INTERACTION_KIND_TAGS
+    logs = _add_columns(db, "interactions", [("kind", "VARCHAR")])
+    for tag, kind in INTERACTION_KIND_TAGS:
+        result = db.execute(
+            text("UPDATE interactions SET kind = :kind WHERE kind IS NULL AND content LIKE :pattern"),
+            {"kind": kind, "pattern": f"%{tag}%"}
+        )
+        if result.rowcount:
+            logs.append(f"✅ interactions: Backfilled kind={kind} ({result.rowcount} rows)")
+    logs += _create_missing_indexes(db, Interaction, ["ix_interactions_kind_log_date"])
+    return logs
+
+def _v6_interaction_amount(db: Session):
+    # Payment amounts extracted once instead of on every dashboard render
+    from utils import backfill_interaction_amounts
+    logs = _add_columns(db, "interactions", [("amount", "INTEGER")])
+    updated = backfill_interaction_amounts(db)
+    if updated:
+        logs.append(f"✅ interactions: Backfilled amount ({updated} rows)")
+    return logs
+
+def _v7_customer_client_name_index(db: Session):
+    return _create_missing_indexes(db, Customer, ["ix_customers_client_name"])
+
+def _v8_log_checkpoints(db: Session):
+    # Log offsets stored next to the rows they produced (batch_processor / messenger_listener)
+    if inspect(db.connection()).has_table("log_checkpoints"):
+        return []
+    LogCheckpoint.__table__.create(bind=db.connection())
+    return ["✅ log_checkpoints: Created table"]
+
+def _v9_log_checkpoint_identity(db: Session):
+    return _add_columns(db, "log_checkpoints", [("file_id", "VARCHAR"), ("head_hash", "VARCHAR")])
+
+def _v10_ai_response_cache(db: Session):
+    if inspect(db.connection()).has_table("ai_response_cache"):
+        return []
+    AIResponseCache.__table__.create(bind=db.connection())
+    return ["✅ ai_response_cache: Created table"]
+
+def _v11_cache_versions(db: Session):
+    # Seeded here so writers only ever UPDATE the row (see utils.bump_cache_version)
+    logs = []
+    if not inspect(db.connection()).has_table("cache_versions"):
+        CacheVersion.__table__.create(bind=db.connection())
+        logs.append("✅ cache_versions: Created table")
+    if db.get(CacheVersion, "customers") is None:
+        db.add(CacheVersion(name="customers", version=0))
+    return logs
+
+def _v12_ai_cache_counters(db: Session):
+    logs = []
+    if not inspect(db.connection()).has_table("ai_cache_counters"):
+        AICacheCounter.__table__.create(bind=db.connection())
+        logs.append("✅ ai_cache_counters: Created table")
+    for name in ("hits", "misses"):
+        if db.get(AICacheCounter, name) is None:
+            db.add(AICacheCounter(name=name, count=0))
+    return logs
+
+# Ordered list of (version, description, step). Append only; never renumber.
+MIGRATIONS = [
+    (1, "quote_items: detailed spec columns", _v1_quote_item_specs),
+    (2, "customers: email", _v2_customer_email),
+    (3, "interactions: category/summary", _v3_interaction_category_summary),
+    (4, "indexes for hot filter columns", _v4_hot_filter_indexes),
+    (5, "interactions: kind column + backfill", _v5_interaction_kind),
+    (6, "interactions: amount column + backfill", _v6_interaction_amount),
+    (7, "customers: client_name index", _v7_customer_client_name_index),
+    (8, "log_checkpoints table", _v8_log_checkpoints),
+    (9, "log_checkpoints: file identity", _v9_log_checkpoint_identity),
+    (10, "ai_response_cache table", _v10_ai_response_cache),
+    (11, "cache_versions table", _v11_cache_versions),
+    (12, "ai_cache_counters table", _v12_ai_cache_counters),
+]
+
+def get_schema_version(db: Session):
+    """Returns the highest applied migration version (0 if none)."""
+    try:
+        return db.query(func.max(SchemaVersion.version)).scalar() or 0
+    except Exception:
+        # Table missing (DB created before versioning) -> create it and start from 0
+        db.rollback()
+        SchemaVersion.__table__.create(bind=db.get_bind(), checkfirst=True)
+        return 0
+
+def run_migrations(db: Session):
+    """
+    Apply pending migration steps in order, one transaction per step.
+    Returns a list of log lines (empty if the schema was already current).
+    Stops at the first failing step so later steps never run on a half-migrated schema.
+    """
+    logs = []
+    current = get_schema_version(db)
+
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        try:
+            logs.extend(step(db))
+            db.add(SchemaVersion(version=version, description=description))
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logs.append(f"❌ Migration Error (v{version} {description}): {e}")
+            break
+
+    return logs
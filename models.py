@@ -1,10 +1,15 @@
-from sqlalchemy import Column, Integer, String, Date, Boolean, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, Date, Boolean, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
+from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import datetime
 from database import Base
 
 class Customer(Base):
     __tablename__ = "customers"
+    __table_args__ = (
+        # Sender -> customer resolution (messenger listener / batch processor)
+        Index("ix_customers_client_name", "client_name"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     company_name = Column(String, unique=True, index=True, nullable=False)
@@ -22,6 +27,10 @@ class Customer(Base):
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_customer_id_order_date", "customer_id", "order_date"),
+        Index("ix_orders_order_date", "order_date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
@@ -36,12 +45,18 @@ class Order(Base):
     # Relationship
     customer = relationship("Customer", back_populates="orders")
 
-    @property
+    @hybrid_property
     def outstanding_amount(self):
         return self.total_amount - self.deposit_amount
 
 class Interaction(Base):
     __tablename__ = "interactions"
+    __table_args__ = (
+        Index("ix_interactions_customer_id_log_date", "customer_id", "log_date"),
+        Index("ix_interactions_log_date", "log_date"),
+        Index("ix_interactions_next_action_date_status", "next_action_date", "status"),
+        Index("ix_interactions_kind_log_date", "kind", "log_date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
@@ -51,6 +66,8 @@ class Interaction(Base):
     status = Column(String) # e.g., 'Contacting', 'Proposed', 'Contracted', 'On Hold'
     category = Column(String) # e.g., 'Quote', 'Order', 'Strategy', 'General'
     summary = Column(String)  # AI Summary or Manual Subject
+    kind = Column(String)     # Tag classification: 'PAYMENT', 'PRICE', 'SCHEDULE', 'INQUIRY' (None = untagged)
+    amount = Column(Integer)  # Payment amount (won) extracted at ingest; None = not found
 
     # Relationship
     customer = relationship("Customer", back_populates="interactions")
@@ -69,6 +86,9 @@ class Product(Base):
 
 class Quote(Base):
     __tablename__ = "quotes"
+    __table_args__ = (
+        Index("ix_quotes_customer_id_quote_date", "customer_id", "quote_date"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     customer_id = Column(Integer, ForeignKey("customers.id"), nullable=False)
@@ -106,3 +126,54 @@ class QuoteItem(Base):
     selected_options = Column(String, default="") 
     
     quote = relationship("Quote", back_populates="quote_items")
+
+# --- SCHEMA VERSIONING ---
+
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    
+    version = Column(Integer, primary_key=True)  # Applied migration step (see migrations.py)
+    description = Column(String)
+    applied_at = Column(DateTime, default=datetime.now)
+
+# --- LOG INGEST CHECKPOINTS ---
+
+class LogCheckpoint(Base):
+    __tablename__ = "log_checkpoints"
+    
+    # One row per log file, e.g. "korea_room:2025-12-21.txt"
+    source = Column(String, primary_key=True)
+    last_pos = Column(Integer, nullable=False, default=0)  # Byte offset after the last processed line
+    file_id = Column(String)    # "dev:inode" of the file (messenger_listener restart check)
+    head_hash = Column(String)  # sha1 of the file's first bytes (see message_rules.head_hash)
+    updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now)
+
+# --- CACHE VERSIONS ---
+
+class CacheVersion(Base):
+    __tablename__ = "cache_versions"
+    
+    # Change counter of a table that other processes cache, e.g. "customers"
+    # (see utils.CustomerNameCache); bumped in the transaction that changes the rows
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+# --- AI RESPONSE CACHE ---
+
+class AIResponseCache(Base):
+    __tablename__ = "ai_response_cache"
+    
+    key = Column(String, primary_key=True)  # sha256 of (model, prompt version, text, product list)
+    model = Column(String)
+    prompt_version = Column(String)
+    response = Column(String)               # JSON result of analyze_text_with_gemini_v4
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.now)   # TTL counts from here
+    last_hit_at = Column(DateTime, default=datetime.now)  # Size eviction drops the least recently used
+
+class AICacheCounter(Base):
+    __tablename__ = "ai_cache_counters"
+    
+    # All-time lookups of ai_response_cache: "hits" / "misses" (AI CRM page metric)
+    name = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
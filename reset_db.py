@@ -1,10 +1,9 @@
-from database import get_db
+from database import session_scope
 import utils
 
-db = next(get_db())
-print("Resetting database...")
-if utils.reset_database(db):
-    print("Database cleared.")
-else:
-    print("Failed to clear database.")
-db.close()
+with session_scope() as db:
+    print("Resetting database...")
+    if utils.reset_database(db):
+        print("Database cleared.")
+    else:
+        print("Failed to clear database.")
@@ -2,5 +2,5 @@
 cd /d "%~dp0"
 call .venv\Scripts\activate
 echo [Running Batch Processor] %date% %time%
-python batch_processor.py
+python batch_processor.py --catch-up 7
 echo Done.
@@ -0,0 +1,10 @@
+@echo off
+title CRM Log Service
+echo CRM Log Service started.
+echo Following the room logs and messenger_log.txt (replaces run_batch.bat + run_messenger.bat).
+echo Keep this window OPEN to maintain the link.
+echo.
+cd /d "%~dp0"
+call .venv\Scripts\activate
+python log_service.py
+pause
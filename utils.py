@@ -1,9 +1,12 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import func
-from models import Customer, Order, Interaction, Product, Quote, QuoteItem
+from sqlalchemy import func, event
+from models import Customer, Order, Interaction, Product, Quote, QuoteItem, LogCheckpoint, AIResponseCache, AICacheCounter, CacheVersion
 from datetime import datetime, date
+import re
+import time
 import pandas as pd
-from database import get_db
+from database import get_db, session_scope, get_setting
+from message_rules import parse_header, RuleMatcher, file_identity, head_hash
 
 # --- Customer Operations ---
 def get_all_customers(db: Session):
@@ -24,6 +27,91 @@ def create_customer(db: Session, customer_data: dict):
     db.refresh(new_customer)
     return new_customer
 
+# --- Sender -> Customer Resolution Cache ---
+# Customers are edited in the app, but the caches live in the log readers (other processes).
+# Any flush that changes or deletes a Customer bumps cache_versions["customers"] in the same
+# transaction; caches compare it on lookup and reload once it moved. New customers need no
+# bump: a cache miss already falls back to a query.
+CUSTOMER_CACHE_VERSION = "customers"
+CUSTOMER_VERSION_CHECK_SECONDS = 1  # how often a cache re-reads the version
+
+def get_cache_version(db: Session, name):
+    return db.query(CacheVersion.version).filter(CacheVersion.name == name).scalar() or 0
+
+def bump_cache_version(db: Session, name):
+    """Increment the version row (inside the caller's transaction)."""
+    table = CacheVersion.__table__
+    conn = db.connection()
+    result = conn.execute(table.update().where(table.c.name == name).values(version=table.c.version + 1))
+    if not result.rowcount:
+        # Row is seeded by migration v11; only missing right after a reset
+        conn.execute(table.insert().values(name=name, version=1))
+
+@event.listens_for(Session, "before_flush")
+def _bump_customer_cache_version(session, flush_context, instances):
+    if any(isinstance(obj, Customer) for obj in (*session.dirty, *session.deleted)):
+        bump_cache_version(session, CUSTOMER_CACHE_VERSION)
+
+class CustomerNameCache:
+    """
+    Maps a messenger sender to a customer id, matching client_name or company_name
+    like the old per-message OR query (lowest id wins). Loaded with one query.
+    
+    Renames/deletes made by any process are picked up within CUSTOMER_VERSION_CHECK_SECONDS
+    through the customers cache version; misses fall back to one indexed query, so
+    customers added by another process are still found.
+    ttl: seconds before a full reload regardless (None = only on version changes).
+    """
+    def __init__(self, ttl=None, check_interval=CUSTOMER_VERSION_CHECK_SECONDS):
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._ids = {}
+        self._loaded_at = None
+        self._checked_at = None
+        self._version = None
+
+    def _is_stale(self, db: Session):
+        if self._loaded_at is None:
+            return True
+        now = time.monotonic()
+        if self.ttl is not None and now - self._loaded_at > self.ttl:
+            return True
+        if now - self._checked_at >= self.check_interval:
+            self._checked_at = now
+            return get_cache_version(db, CUSTOMER_CACHE_VERSION) != self._version
+        return False
+
+    def load(self, db: Session):
+        # Version first: a change made while loading shows up as stale on the next check
+        self._version = get_cache_version(db, CUSTOMER_CACHE_VERSION)
+        ids = {}
+        # Highest id first, so lower ids overwrite (same result as .first() by id)
+        for cid, client, company in db.query(Customer.id, Customer.client_name, Customer.company_name).order_by(Customer.id.desc()):
+            if company: ids[company] = cid
+            if client: ids[client] = cid
+        self._ids = ids
+        self._loaded_at = self._checked_at = time.monotonic()
+
+    def invalidate(self):
+        self._loaded_at = None
+
+    def get(self, db: Session, name):
+        """Customer id for this sender name, or None."""
+        if self._is_stale(db):
+            self.load(db)
+        cid = self._ids.get(name)
+        if cid is None:
+            cid = db.query(Customer.id).filter(
+                (Customer.client_name == name) | (Customer.company_name == name)
+            ).order_by(Customer.id).limit(1).scalar()
+            if cid is not None:
+                self._ids[name] = cid
+        return cid
+
+    def add(self, name, customer_id):
+        """Record a customer created by the caller (e.g. a messenger guest)."""
+        self._ids.setdefault(name, customer_id)
+
 def update_interaction_status(db: Session, interaction_id: int, new_status: str):
     """Update status and clear next_action_date (mark as done)"""
     interaction = db.query(Interaction).filter(Interaction.id == interaction_id).first()
@@ -35,81 +123,14 @@ def update_interaction_status(db: Session, interaction_id: int, new_status: str)
     return False
 
 
-from sqlalchemy import text
-
 def run_db_migration(db: Session):
     """
-    Manually add missing columns to the remote database.
-    This is fail-safe: it attempts to add columns and ignores errors if they exist.
-    """
-    logs = []
-    
-    # Define columns to add to 'quote_items'
-    # Format: (column_name, data_type)
-    # Using Generic SQL types that work on Postgres/SQLite (mostly)
-    # Postgres supports IF NOT EXISTS. SQLite doesn't always.
-    # We will use try-except blocks with simple ADD COLUMN for maximum compatibility if we don't know the engine.
-    # But for Postgres (Streamlit Cloud), we can use IF NOT EXISTS if we are sure.
-    # Let's stick to try-except which covers both.
-    
-    new_cols = [
-        ("print_type", "VARCHAR"),
-        ("origin", "VARCHAR"),
-        ("color", "VARCHAR"),
-        ("cutting", "BOOLEAN DEFAULT FALSE"),
-        ("remote_control", "BOOLEAN DEFAULT FALSE"),
-        ("due_date", "VARCHAR"),
-        ("note", "VARCHAR"),
-        ("selected_options", "VARCHAR") # Just in case
-    ]
-    
-    # 1. Quote Items Migration
-    for col, dtype in new_cols:
-        try:
-             sql = f"ALTER TABLE quote_items ADD COLUMN {col} {dtype}"
-             db.execute(text(sql))
-             db.commit()
-             logs.append(f"✅ QuoteItems: Added '{col}'")
-        except Exception as e:
-            db.rollback()
-            # ... existing error handling ...
-            pass # Simplified for brevity in replace, keep logic if possible or assume duplicate check
-            
-            # Re-implement robust check
-            err = str(e).lower()
-            if "duplicate checking" in err or "already exists" in err:
-                 pass
-            else:
-                 try:
-                     sql_pg = f"ALTER TABLE quote_items ADD COLUMN IF NOT EXISTS {col} {dtype}"
-                     db.execute(text(sql_pg))
-                     db.commit()
-                     logs.append(f"✅ QuoteItems: Added '{col}' (PG)")
-                 except:
-                     db.rollback()
-
-    # 2. Customers Migration (Add Email)
-    try:
-        db.execute(text("ALTER TABLE customers ADD COLUMN email VARCHAR"))
-        db.commit()
-        logs.append("✅ Customers: Added 'email'")
-    except Exception as e:
-        db.rollback()
-        pass
-
-    # 3. Interactions Migration (New: Category/Summary)
-    int_cols = [("category", "VARCHAR"), ("summary", "VARCHAR")]
-    for col, dtype in int_cols:
-        try:
-            db.execute(text(f"ALTER TABLE interactions ADD COLUMN {col} {dtype}"))
-            db.commit()
-            logs.append(f"✅ Interactions: Added '{col}'")
-        except:
-            db.rollback()
-            pass
-
-    
-    return logs
+    Bring the database schema up to date.
+    Delegates to the versioned runner in migrations.py: one version check,
+    then only the pending steps are applied.
+    """
+    from migrations import run_migrations
+    return run_migrations(db)
 
 # --- MESSENGER RULES ---
 MESSENGER_RULES = [
@@ -118,15 +139,16 @@ MESSENGER_RULES = [
     # 2. 💰 입금 (Payment) - Strict (Sender must be 권병구)
     {"type": "PAYMENT", "keywords": ["입금액", "입금액입니다", "카드결제"], "label": "💰 입금"},
 ]
+# Compiled once; rule order is the priority (first rule wins)
+MESSENGER_MATCHER = RuleMatcher(MESSENGER_RULES)
+MESSENGER_LABELS = {r["type"]: r["label"] for r in MESSENGER_RULES}
 
 def parse_messenger_logs(text):
     """
     Parses raw messenger text into structure data for tracking.
     Returns: List of dicts 
     """
-    import re
     lines = text.splitlines()
-    header_pattern = re.compile(r"^\[(\d{4}-\d{2}-\d{2}) (오전|오후) (\d{1,2}:\d{2})\] (.*)")
     
     parsed_msgs = []
     current_msg = None
@@ -135,24 +157,15 @@ def parse_messenger_logs(text):
         line = line.strip()
         if not line: continue
         
-        match = header_pattern.match(line)
-        if match:
+        header = parse_header(line)
+        if header:
             # Save previous
             if current_msg:
                 parsed_msgs.append(current_msg)
             
             # Start new
-            date_str, ampm, time_str, sender = match.groups()
-            hour, minute = map(int, time_str.split(':'))
-            if ampm == "오후" and hour != 12: hour += 12
-            elif ampm == "오전" and hour == 12: hour = 0
-            
-            try:
-                dt = datetime.strptime(f"{date_str} {hour:02d}:{minute:02d}:00", "%Y-%m-%d %H:%M:%S")
-            except:
-                dt = datetime.now()
-                
-            current_msg = {"date": dt, "sender": sender.strip(), "text": "", "type": "ETC", "value": 0, "extra": ""}
+            dt, sender = header
+            current_msg = {"date": dt, "sender": sender, "text": "", "type": "ETC", "value": 0, "extra": ""}
         else:
             if current_msg:
                 current_msg["text"] += "\n" + line
@@ -169,11 +182,7 @@ def parse_messenger_logs(text):
         msg["text"] = txt
         
         # Categorize (Strict)
-        msg_type = None
-        for rule in MESSENGER_RULES:
-            if any(k in txt for k in rule["keywords"]):
-                msg_type = rule["type"]
-                break
+        msg_type = MESSENGER_MATCHER.classify(txt)
         
         # ⚠️ Strict Filter for Manual Mode: Skip if no rule matched
         if not msg_type:
@@ -185,10 +194,9 @@ def parse_messenger_logs(text):
         
         msg["type"] = msg_type
         # Add label
-        msg["type_label"] = next((r["label"] for r in MESSENGER_RULES if r["type"] == msg_type), "기타")
+        msg["type_label"] = MESSENGER_LABELS.get(msg_type, "기타")
         
         # Logic for Values (Quantity or Amount)
-        import re
         
         # 1. 🚨 Order
         if msg_type == "ORDER":
@@ -239,6 +247,146 @@ def parse_messenger_logs(text):
     
     return results
 
+# --- INTERACTION KINDS ---
+# Content tags written by batch_processor / manual import, in priority order.
+# Persisted as Interaction.kind so the dashboard can filter in SQL.
+INTERACTION_KIND_TAGS = [
+    ("[입금확인]", "PAYMENT"),
+    ("[단가변동]", "PRICE"),
+    ("[납기확인]", "SCHEDULE"),
+    ("[문의]", "INQUIRY"),
+]
+
+# Interaction.kind -> activity bucket used by the dashboard
+ACTIVITY_KIND_BUCKETS = {
+    "PAYMENT": "payments",
+    "PRICE": "prices",
+    "SCHEDULE": "prices",  # Group schedule with price/notices
+    "INQUIRY": "others",
+}
+
+def classify_interaction_kind(content):
+    """Returns the kind for the first matching tag in content, or None."""
+    if not content:
+        return None
+    for tag, kind in INTERACTION_KIND_TAGS:
+        if tag in content:
+            return kind
+    return None
+
+# --- PAYMENT AMOUNTS ---
+# "50,000원" / "5만원" style mentions. 만원 is scaled to won.
+PAYMENT_AMOUNT_PATTERN = re.compile(r'([\d,]+)\s*(만원|원)')
+
+def _payment_amounts(text):
+    """All positive amounts (in won) mentioned in text, in order."""
+    amounts = []
+    for digits, unit in PAYMENT_AMOUNT_PATTERN.findall(text or ""):
+        try:
+            val = int(digits.replace(",", ""))
+        except ValueError:
+            continue
+        if val > 0:
+            amounts.append(val * 10000 if unit == "만원" else val)
+    return amounts
+
+def extract_payment_amount(text, context_texts=()):
+    """
+    Payment amount for a message: first amount in the text itself, otherwise the
+    last amount found in the surrounding messages (context_texts, oldest first).
+    Returns int, or None if nothing was found.
+    """
+    direct = _payment_amounts(text)
+    if direct:
+        return direct[0]
+    for ctx in reversed(list(context_texts)):
+        found = _payment_amounts(ctx)
+        if found:
+            return found[-1]
+    return None
+
+def backfill_interaction_amounts(db: Session, window=5, batch_size=500):
+    """
+    One-shot job (run by migration v6): fill Interaction.amount for existing payments.
+    Direct match in the content first, then the same-sender context window
+    (previously recomputed by the dashboard on every render).
+    Uses column-only queries so it is safe while later migrations are still pending.
+    Returns the number of rows updated.
+    """
+    from sqlalchemy import update, bindparam
+    
+    rows = db.query(Interaction.id, Interaction.content, Customer.company_name)\
+             .join(Interaction.customer)\
+             .filter(Interaction.kind == "PAYMENT", Interaction.amount == None)\
+             .order_by(Interaction.id).all()
+    
+    updated = 0
+    stmt = update(Interaction.__table__).where(Interaction.__table__.c.id == bindparam("row_id")).values(amount=bindparam("row_amount"))
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        amounts = {r.id: extract_payment_amount(r.content) for r in batch}
+        missing = [r for r in batch if amounts[r.id] is None]
+        if missing:
+            contexts = get_interaction_contexts(db, [r.id for r in missing], window=window,
+                                                senders={r.id: r.company_name for r in missing})
+            for r in missing:
+                # Context format: "[id] content || [id] content"
+                amounts[r.id] = extract_payment_amount("", contexts.get(r.id, "").split(" || "))
+        
+        params = [{"row_id": rid, "row_amount": amt} for rid, amt in amounts.items() if amt is not None]
+        if params:
+            db.execute(stmt, params)
+            updated += len(params)
+    return updated
+
+class PaymentDeduplicator:
+    """
+    Incremental de-dup for payment reports keyed on (sender, amount).
+    A report is a duplicate when the same sender reported the same amount less than
+    window_seconds after the last accepted report, no matter how many other senders'
+    messages are interleaved in between. Hash-map lookup, so O(1) per event.
+    Entries are grouped into window-sized time buckets and dropped once they can no
+    longer match, so memory stays bounded on long streams (events roughly in time order).
+    Events without an amount or timestamp are never treated as duplicates.
+    """
+    def __init__(self, window_seconds=60):
+        self.window_seconds = window_seconds
+        self._last_seen = {}   # (sender, amount) -> timestamp of last accepted report
+        self._buckets = {}     # bucket id -> set of keys accepted in that bucket
+
+    @staticmethod
+    def _as_datetime(ts):
+        # Interaction.log_date is a date; treat it as midnight
+        if isinstance(ts, datetime):
+            return ts
+        return datetime.combine(ts, datetime.min.time())
+
+    def is_duplicate(self, sender, amount, timestamp):
+        """Check a report and remember it if it is new. Returns True for duplicates."""
+        if not amount or timestamp is None:
+            return False
+        ts = self._as_datetime(timestamp)
+        key = (sender, amount)
+        last = self._last_seen.get(key)
+        if last is not None and abs((ts - last).total_seconds()) < self.window_seconds:
+            return True
+        
+        self._last_seen[key] = ts
+        bucket = int(ts.timestamp() // self.window_seconds)
+        self._buckets.setdefault(bucket, set()).add(key)
+        self._evict(bucket)
+        return False
+
+    def _evict(self, current_bucket):
+        # Anything older than the previous bucket is more than one window away.
+        # Only a couple of buckets are live at a time, so this scan is O(1) per event.
+        stale = [b for b in self._buckets if b < current_bucket - 1]
+        for b in stale:
+            for key in self._buckets.pop(b):
+                last = self._last_seen.get(key)
+                if last is not None and int(last.timestamp() // self.window_seconds) == b:
+                    del self._last_seen[key]
+
 def get_recent_messenger_activity(db: Session, days=7):
     """
     Fetch recent auto-processed messenger logs from DB.
@@ -250,11 +398,21 @@ def get_recent_messenger_activity(db: Session, days=7):
     # 1. Orders (Manual or Batch)
     # Filter by checking if note contains "원본:" or just all recent orders?
     # Let's show all recent orders for safety
-    orders = db.query(Order).filter(Order.order_date >= cutoff).order_by(Order.id.desc()).all()
+    # Column-only join: customer fields come back in the same row (no per-order Customer lazy load)
+    orders = db.query(Order.order_date, Order.product_name, Order.quantity, Order.note,
+                      Customer.company_name, Customer.sales_rep)\
+               .join(Order.customer)\
+               .filter(Order.order_date >= cutoff)\
+               .order_by(Order.id.desc()).all()
     
     # 2. Interactions (Payment, Price, Schedule)
     # Filter by specific tags we added in batch_processor
-    interactions = db.query(Interaction).filter(Interaction.log_date >= cutoff).order_by(Interaction.id.desc()).all()
+    # Only tagged kinds are transferred (untagged rows stay in the DB)
+    interactions = db.query(Interaction.id, Interaction.log_date, Interaction.content, Interaction.kind, Interaction.amount,
+                            Customer.company_name)\
+                     .join(Interaction.customer)\
+                     .filter(Interaction.log_date >= cutoff, Interaction.kind.in_(list(ACTIVITY_KIND_BUCKETS)))\
+                     .order_by(Interaction.id.desc()).all()
     
     activity = {
         "orders": [],
@@ -266,8 +424,8 @@ def get_recent_messenger_activity(db: Session, days=7):
     # Process Orders
     for o in orders:
         activity['orders'].append({
-            "sender": o.customer.company_name,
-            "sales_rep": o.customer.sales_rep, # Added Sales Rep
+            "sender": o.company_name,
+            "sales_rep": o.sales_rep, # Added Sales Rep
             "date": o.order_date,
             "product": o.product_name or '상품미지정', # Explicit product name
             "text": f"{o.product_name or '상품미지정'} {o.quantity}개",
@@ -277,53 +435,94 @@ def get_recent_messenger_activity(db: Session, days=7):
         
     # Process Interactions
     for i in interactions:
-        txt = i.content
+        txt = i.content or ""
         item = {
-            "sender": i.customer.company_name,
+            "sender": i.company_name,
             "date": i.log_date,
             "text": txt,
-            "value": 0,
+            "value": i.amount or 0,
+            "amount": i.amount,  # Stored at ingest (None = not found)
             "id": i.id  # Added ID for context lookup
         }
         
-        if "[입금확인]" in txt:
-            activity['payments'].append(item)
-        elif "[단가변동]" in txt:
-            activity['prices'].append(item)
-        elif "[납기확인]" in txt:
-            activity['prices'].append(item) # Group schedule with price/notices
-        elif "[문의]" in txt:
-             activity['others'].append(item)
+        activity[ACTIVITY_KIND_BUCKETS[i.kind]].append(item)
              
     return activity
 
-def get_interaction_context(db: Session, interaction_id: int, window=5, limit_to_sender=None):
+def index_activity_by_date(activity, keys=("orders", "payments")):
     """
-    Finds surrounding messages. Increased window size for better detection.
-    Prioritizes backward search for amounts.
-    If limit_to_sender is provided, only includes messages from that sender (company_name).
+    Bucket activity lists by their 'date' in a single pass (O(events)).
+    Returns (index, counts):
+      index[date][key]  -> list of items for that day
+      counts[date][key] -> number of items for that day
+    Days without events are absent, so callers use .get(day, {}).
     """
-    # Search window [id-window, id+1]
-    min_id = max(1, interaction_id - window)
-    max_id = interaction_id + 1 
+    index = {}
+    for key in keys:
+        for item in activity.get(key, []):
+            day = index.setdefault(item["date"], {k: [] for k in keys})
+            day[key].append(item)
     
-    query = db.query(Interaction).filter(
-        Interaction.id >= min_id, 
-        Interaction.id <= max_id
-    )
+    counts = {d: {k: len(items) for k, items in day.items()} for d, day in index.items()}
+    return index, counts
+
+# OR'ed id ranges per context query (keeps the SQL statement small)
+CONTEXT_RANGES_PER_QUERY = 50
+
+def get_interaction_contexts(db: Session, interaction_ids, window=5, senders: dict = None):
+    """
+    Batch version of get_interaction_context: context text for many interactions in one query.
+    Each id's window is [id-window, id+1]; overlapping windows are merged into id ranges,
+    fetched with one query per CONTEXT_RANGES_PER_QUERY ranges, then sliced per id in memory.
+    senders: optional {interaction_id: company_name} to keep only that sender's messages.
+    Returns {interaction_id: context_text}.
+    """
+    import bisect
+    from sqlalchemy import or_
     
-    if limit_to_sender:
-        query = query.join(Interaction.customer).filter(Customer.company_name == limit_to_sender)
-        
-    neighbors = query.order_by(Interaction.id).all()
+    ids = sorted(set(interaction_ids))
+    if not ids:
+        return {}
+    senders = senders or {}
+    
+    # Merge overlapping windows -> few ranges
+    ranges = []
+    for iid in ids:
+        lo, hi = max(1, iid - window), iid + 1
+        if ranges and lo <= ranges[-1][1] + 1:
+            ranges[-1][1] = max(ranges[-1][1], hi)
+        else:
+            ranges.append([lo, hi])
     
-    # Format: [content] || ...
-    context_text = " || ".join([f"[{n.id}] {n.content}" for n in neighbors])
-    return context_text
+    # Very scattered ids: a few queries of CONTEXT_RANGES_PER_QUERY ranges each (never a
+    # single span, which would load every row between the first and last id)
+    rows = []
+    for i in range(0, len(ranges), CONTEXT_RANGES_PER_QUERY):
+        id_filter = or_(*[Interaction.id.between(lo, hi) for lo, hi in ranges[i:i + CONTEXT_RANGES_PER_QUERY]])
+        rows += db.query(Interaction.id, Interaction.content, Customer.company_name)\
+                  .join(Interaction.customer)\
+                  .filter(id_filter)\
+                  .order_by(Interaction.id).all()
+    row_ids = [r.id for r in rows]
     
-    # Format: [Date Time] Content
-    context_text = " || ".join([f"[{n.id}] {n.content}" for n in neighbors])
-    return context_text
+    contexts = {}
+    for iid in ids:
+        start = bisect.bisect_left(row_ids, max(1, iid - window))
+        end = bisect.bisect_right(row_ids, iid + 1)
+        sender = senders.get(iid)
+        neighbors = [r for r in rows[start:end] if not sender or r.company_name == sender]
+        # Format: [id] content || ...
+        contexts[iid] = " || ".join([f"[{n.id}] {n.content}" for n in neighbors])
+    return contexts
+
+def get_interaction_context(db: Session, interaction_id: int, window=5, limit_to_sender=None):
+    """
+    Finds surrounding messages. Increased window size for better detection.
+    Prioritizes backward search for amounts.
+    If limit_to_sender is provided, only includes messages from that sender (company_name).
+    """
+    senders = {interaction_id: limit_to_sender} if limit_to_sender else None
+    return get_interaction_contexts(db, [interaction_id], window=window, senders=senders)[interaction_id]
 
 
 def reset_database(db: Session):
@@ -332,6 +531,7 @@ def reset_database(db: Session):
         db.query(Interaction).delete()
         db.query(Order).delete()
         db.query(Customer).delete()
+        bump_cache_version(db, CUSTOMER_CACHE_VERSION)  # bulk delete skips the flush hook
         db.commit()
         return True
     except Exception as e:
@@ -340,19 +540,31 @@ def reset_database(db: Session):
         return False
 
 # --- Interaction Operations ---
-def add_interaction(db: Session, customer_id: int, content: str, next_action_date: date, status: str, category: str = "General", summary: str = "", log_date: date = None):
+def interaction_row(customer_id: int, content: str, next_action_date: date, status: str, category: str = "General", summary: str = "", log_date: date = None, kind: str = None, amount: int = None):
+    """Column values for one Interaction (shared by add_interaction and BulkLogWriter)."""
     if log_date is None:
         log_date = date.today()
-        
-    new_interaction = Interaction(
-        customer_id=customer_id,
-        content=content,
-        next_action_date=next_action_date,
-        status=status,
-        category=category,
-        summary=summary,
-        log_date=log_date
-    )
+    kind = kind or classify_interaction_kind(content)
+    if amount is None and kind == "PAYMENT":
+        # Extract once at ingest; the dashboard reads the stored number
+        amount = extract_payment_amount(content)
+    return {
+        "customer_id": customer_id,
+        "content": content,
+        "next_action_date": next_action_date,
+        "status": status,
+        "category": category,
+        "summary": summary,
+        "log_date": log_date,
+        "kind": kind,
+        "amount": amount,
+    }
+
+def add_interaction(db: Session, customer_id: int, content: str, next_action_date: date, status: str, category: str = "General", summary: str = "", log_date: date = None, kind: str = None, amount: int = None):
+    new_interaction = Interaction(**interaction_row(
+        customer_id, content, next_action_date, status,
+        category=category, summary=summary, log_date=log_date, kind=kind, amount=amount
+    ))
     db.add(new_interaction)
     db.commit()
     db.refresh(new_interaction)
@@ -365,22 +577,118 @@ def get_interactions_by_customer(db: Session, customer_id: int):
 def get_orders_by_customer(db: Session, customer_id: int):
     return db.query(Order).filter(Order.customer_id == customer_id).order_by(Order.order_date.desc()).all()
 
+def order_row(customer_id: int, order_date, product_name, quantity, total_amount, deposit_amount, note):
+    """Column values for one Order (shared by create_order and BulkLogWriter)."""
+    return {
+        "customer_id": customer_id,
+        "order_date": order_date,
+        "product_name": product_name,
+        "quantity": quantity,
+        "total_amount": total_amount,
+        "deposit_amount": deposit_amount,
+        "is_ordered": True, # Manual entry implies it's an order
+        "note": note,
+    }
+
 def create_order(db: Session, customer_id: int, order_date, product_name, quantity, total_amount, deposit_amount, note):
-    new_order = Order(
-        customer_id=customer_id,
-        order_date=order_date,
-        product_name=product_name,
-        quantity=quantity,
-        total_amount=total_amount,
-        deposit_amount=deposit_amount,
-        is_ordered=True, # Manual entry implies it's an order
-        note=note
-    )
+    new_order = Order(**order_row(customer_id, order_date, product_name, quantity, total_amount, deposit_amount, note))
     db.add(new_order)
     db.commit()
     db.refresh(new_order)
     return new_order
 
+class BulkLogWriter:
+    """
+    Buffered writer for the log processors.
+    Same arguments as add_interaction/create_order, but rows are collected and
+    inserted with one executemany per table every `flush_every` rows.
+    It never commits: the caller commits once per file, so a file's rows
+    (and its read offset) succeed or fail together.
+    """
+    def __init__(self, db: Session, flush_every=500):
+        self.db = db
+        self.flush_every = flush_every
+        self.interactions = []
+        self.orders = []
+        self.written = {"interactions": 0, "orders": 0}
+
+    def add_interaction(self, *args, **kwargs):
+        self.interactions.append(interaction_row(*args, **kwargs))
+        self._maybe_flush()
+
+    def create_order(self, *args, **kwargs):
+        self.orders.append(order_row(*args, **kwargs))
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self.interactions) + len(self.orders) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """Insert buffered rows (inside the caller's transaction). Returns total rows written."""
+        if self.interactions:
+            self.db.execute(Interaction.__table__.insert(), self.interactions)
+            self.written["interactions"] += len(self.interactions)
+            self.interactions = []
+        if self.orders:
+            self.db.execute(Order.__table__.insert(), self.orders)
+            self.written["orders"] += len(self.orders)
+            self.orders = []
+        return self.written["interactions"] + self.written["orders"]
+
+# --- Log Checkpoints ---
+# Byte offsets of processed log files. set_log_checkpoint does not commit: the caller
+# commits it together with the rows parsed from those bytes, so a crash either keeps
+# both or neither (no lost or duplicated messages on restart).
+def get_log_checkpoint(db: Session, source: str):
+    """Returns the saved byte offset for this source, or None if never processed."""
+    return db.query(LogCheckpoint.last_pos).filter(LogCheckpoint.source == source).scalar()
+
+def load_log_checkpoint(db: Session, source: str):
+    """Returns the LogCheckpoint row (offset + file identity) or None."""
+    return db.get(LogCheckpoint, source)
+
+def set_log_checkpoint(db: Session, source: str, last_pos: int, file_id: str = None, head_hash: str = None):
+    checkpoint = db.get(LogCheckpoint, source)
+    if not checkpoint:
+        checkpoint = LogCheckpoint(source=source)
+        db.add(checkpoint)
+    checkpoint.last_pos = last_pos
+    if file_id is not None:
+        checkpoint.file_id = file_id
+    if head_hash is not None:
+        checkpoint.head_hash = head_hash
+    db.flush()
+
+def resume_log_offset(db: Session, source: str, path: str, first_run_pos: int = 0):
+    """
+    Offset to continue reading a live log from, checked with one stat and at most
+    HEAD_HASH_BYTES read: the saved offset if it is still the same file, 0 if it was
+    truncated or replaced, first_run_pos if it has no checkpoint yet.
+    """
+    import os
+    stat = os.stat(path)
+    saved = load_log_checkpoint(db, source)
+    if saved is None:
+        return first_run_pos
+    
+    current_id = file_identity(stat)
+    if stat.st_size < saved.last_pos:
+        print(f"{path}: truncated since last run -> reading from start")
+        return 0
+    if saved.file_id and current_id and saved.file_id != current_id:
+        print(f"{path}: rotated since last run -> reading from start")
+        return 0
+    if saved.head_hash and head_hash(path, saved.last_pos) != saved.head_hash:
+        print(f"{path}: replaced since last run -> reading from start")
+        return 0
+    print(f"{path}: resuming at byte {saved.last_pos} ({stat.st_size - saved.last_pos} new bytes)")
+    return saved.last_pos
+
+def save_log_offset(db: Session, source: str, path: str, end: int, file_id: str = None):
+    """set_log_checkpoint plus the file's head hash, for resume_log_offset. Does not commit."""
+    set_log_checkpoint(db, source, end, file_id=file_id, head_hash=head_hash(path, end))
+
 # --- Dashboard Metrics ---
 def get_todays_calls(db: Session):
     today = date.today()
@@ -396,45 +704,54 @@ def get_monthly_sales(db: Session):
     return total_sales
 
 def get_total_receivables(db: Session):
-    # Total Amount - Total Deposit
-    orders = db.query(Order).all()
-    total_receivable = sum(o.outstanding_amount for o in orders)
-    return total_receivable
+    # Total Amount - Total Deposit (summed in SQL, not row by row)
+    total_receivable = db.query(func.coalesce(func.sum(Order.outstanding_amount), 0)).scalar()
+    return int(total_receivable)
 
-def get_monthly_sales_trend(db: Session):
+def month_bucket(db: Session, column):
+    """
+    Dialect-aware 'YYYY-MM' bucket expression for a date column.
+    PostgreSQL: to_char(date_trunc('month', col)), SQLite: strftime('%Y-%m', col).
+    """
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        return func.to_char(func.date_trunc("month", column), "YYYY-MM")
+    if dialect == "sqlite":
+        return func.strftime("%Y-%m", column)
+    # Generic fallback (MySQL and friends)
+    return func.date_format(column, "%Y-%m")
+
+def get_monthly_sales_trend(db: Session, start_date: date = None, end_date: date = None):
     """
     Returns a dataframe-like list for sales trend.
-    Group by Month.
+    Group by Month (in the database), optionally limited to [start_date, end_date].
     """
-    # SQLite has limited date functions, so fetching all orders and processing in python is safer for small scale.
-    # For large scale, use SQL group by.
-    orders = db.query(Order).filter(Order.is_ordered == True).all()
+    bucket = month_bucket(db, Order.order_date).label("month")
+    query = db.query(bucket, func.coalesce(func.sum(Order.total_amount), 0))\
+              .filter(Order.is_ordered == True, Order.order_date != None)
     
-    data = {}
-    for o in orders:
-        if not o.order_date: continue
-        month_key = o.order_date.strftime("%Y-%m")
-        data[month_key] = data.get(month_key, 0) + o.total_amount
+    if start_date:
+        query = query.filter(Order.order_date >= start_date)
+    if end_date:
+        query = query.filter(Order.order_date <= end_date)
         
-    # Sort by date
-    sorted_data = sorted(data.items())
-    return {"Date": [x[0] for x in sorted_data], "Sales": [x[1] for x in sorted_data]}
+    rows = query.group_by(bucket).order_by(bucket).all()
+    return {"Date": [r[0] for r in rows], "Sales": [int(r[1]) for r in rows]}
 
 def get_top_receivables(db: Session, limit=5):
     """
     Returns top N customers with highest outstanding debt.
+    Aggregated per customer in a single GROUP BY query (no per-customer order loads).
     """
-    customers = db.query(Customer).all()
-    debt_list = []
+    debt = func.sum(Order.outstanding_amount)
+    results = db.query(Customer.company_name, Customer.sales_rep, debt.label("receivable"))\
+                .join(Order)\
+                .group_by(Customer.id, Customer.company_name, Customer.sales_rep)\
+                .having(debt > 0)\
+                .order_by(debt.desc())\
+                .limit(limit).all()
     
-    for c in customers:
-        debt = sum(o.outstanding_amount for o in c.orders)
-        if debt > 0:
-            debt_list.append({"Company": c.company_name, "Receivable": debt, "Rep": c.sales_rep})
-            
-    # Sort desc
-    debt_list.sort(key=lambda x: x["Receivable"], reverse=True)
-    return debt_list[:limit]
+    return [{"Company": company, "Receivable": int(receivable), "Rep": rep} for company, rep, receivable in results]
 
 def get_sales_by_industry(db: Session):
     """
@@ -478,125 +795,233 @@ def get_scheduled_interactions(db: Session, filter_type="all"):
     
     return []
 
-def process_csv_data(db: Session, df: pd.DataFrame):
+def _csv_text(df: pd.DataFrame, col, strip=True):
+    """Column as strings, '' for missing/NaN (same as str(row.get(col, '')) with 'nan' -> '')."""
+    if col not in df.columns:
+        return pd.Series("", index=df.index, dtype=object)
+    values = df[col].fillna("").astype(str)
+    if strip:
+        values = values.str.strip()
+    return values.mask(values == "nan", "")
+
+def _csv_number(df: pd.DataFrame, col):
+    """
+    Vectorized clean_number: strip commas, find all numbers in each cell and sum them
+    (e.g. "1,000" -> 1000, "500/600" -> 1100; heuristic for messy data). Missing -> 0.
+    Returns floats; process_csv_data rejects values that don't fit an INTEGER column.
+    """
+    if col not in df.columns:
+        return pd.Series(0.0, index=df.index)
+    values = df[col].fillna("").astype(str).str.replace(",", "", regex=False)
+    found = values.str.extractall(r"(-?\d+\.?\d*)")[0].astype(float)
+    return found.groupby(level=0).sum().reindex(df.index, fill_value=0.0)
+
+# Largest value an INTEGER column accepts (64-bit); bigger CSV numbers are row errors
+CSV_MAX_NUMBER = 2 ** 63 - 1
+CSV_NUMBER_COLUMNS = ["quantity", "total_amount", "deposit_amount"]
+
+def process_csv_data(db: Session, df: pd.DataFrame, customer_ids: dict = None):
     """
     Process uploaded CSV dataframe and import to DB.
     Handles duplicate '담당자' columns: 1st=sales_rep, 2nd=client_name
+    
+    Columns are cleaned with vectorized pandas ops, and customers/orders are each
+    written with one bulk INSERT inside a single transaction.
+    customer_ids: {company_name: id} shared by the chunks of one import (new customers
+    are added after the commit); prefetched here when not given.
+    Rows whose numbers can't be stored are skipped and counted in 'errors'. A DB error
+    rolls the whole chunk back and is re-raised.
     """
-    # 1. Handle duplicate column names
-    # Pandas usually renames duplicates to 'Col', 'Col.1' etc.
-    # We expect '담당자', '담당자.1' if they are exact duplicates in header.
+    stats = {"new_customers": 0, "new_orders": 0, "errors": 0}
     
-    # Map for renaming to internal model fields
-    # Adjust based on exact CSV headers user might have. 
-    # Try generic matching just in case.
+    # Pandas usually renames duplicate headers to '담당자', '담당자.1' -> pick by position
+    df = df.reset_index(drop=True)
+    manager_indices = [i for i, c in enumerate(df.columns) if '담당자' in str(c)]
     
-    # We will iterate row by row for safety and complex logic
+    def manager_column(pos):
+        if len(manager_indices) <= pos:
+            return pd.Series("", index=df.index, dtype=object)
+        col = df.iloc[:, manager_indices[pos]].fillna("").astype(str).str.strip()
+        return col.mask(col == "nan", "")
     
-    stats = {"new_customers": 0, "new_orders": 0, "errors": 0}
+    rows = pd.DataFrame({
+        "company": _csv_text(df, '상호명'),
+        "sales_rep": manager_column(0),
+        "client_name": manager_column(1),
+        "phone": _csv_text(df, '연락처'),
+        "industry": _csv_text(df, '업종'),
+        "product_name": _csv_text(df, '상품명', strip=False),
+        "note": _csv_text(df, '비고', strip=False),
+        "quantity": _csv_number(df, '수량'),
+        "total_amount": _csv_number(df, '총가격'),
+        "deposit_amount": _csv_number(df, '입금액'),
+    })
+    
+    # Skip rows without a company name
+    rows = rows[rows["company"] != ""]
+    
+    # Row errors: numbers too large for an INTEGER column (or inf)
+    valid = rows[CSV_NUMBER_COLUMNS].abs().le(CSV_MAX_NUMBER).all(axis=1)
+    stats['errors'] = int((~valid).sum())
+    rows = rows[valid]
+    if rows.empty:
+        return stats
+    rows[CSV_NUMBER_COLUMNS] = rows[CSV_NUMBER_COLUMNS].astype("int64")
     
-    # Identify columns
-    cols = df.columns.tolist()
+    # Dates: parse the whole column at once; unparseable -> today
+    if '날짜' in df.columns:
+        parsed = pd.to_datetime(df.loc[rows.index, '날짜'].astype(str), errors="coerce", format="mixed")
+        rows["order_date"] = [d.date() if not pd.isna(d) else date.today() for d in parsed]
+    else:
+        rows["order_date"] = date.today()
     
-    # Find indices of '담당자'
-    manager_indices = [i for i, c in enumerate(cols) if '담당자' in c]
+    if customer_ids is None:
+        customer_ids = dict(db.query(Customer.company_name, Customer.id).all())
     
-    for _, row in df.iterrows():
+    try:
+        # 1. Customers: one bulk insert for the new ones (first row wins)
+        new_customers = rows[~rows["company"].isin(customer_ids.keys())].drop_duplicates("company", keep="first")
+        chunk_ids = {}
+        
+        if not new_customers.empty:
+            db.execute(Customer.__table__.insert(), [
+                {
+                    "company_name": r["company"],
+                    "client_name": r["client_name"],
+                    "phone": r["phone"],
+                    "industry": r["industry"],
+                    "sales_rep": r["sales_rep"],
+                }
+                for r in new_customers.to_dict("records")
+            ])
+            names = new_customers["company"].tolist()
+            chunk_ids = dict(db.query(Customer.company_name, Customer.id).filter(Customer.company_name.in_(names)).all())
+            stats['new_customers'] = len(new_customers)
+        
+        # 2. Orders: one bulk insert
+        order_rows = [
+            {
+                "customer_id": chunk_ids.get(r["company"]) or customer_ids[r["company"]],
+                "order_date": r["order_date"],
+                "product_name": r["product_name"] or None,
+                "quantity": int(r["quantity"]),
+                "total_amount": int(r["total_amount"]),
+                "deposit_amount": int(r["deposit_amount"]),
+                "is_ordered": True,
+                "note": r["note"] or None,
+            }
+            for r in rows.to_dict("records")
+        ]
+        db.execute(Order.__table__.insert(), order_rows)
+        stats['new_orders'] = len(order_rows)
+        
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    
+    customer_ids.update(chunk_ids)
+    return stats
+
+# --- Chunked CSV Import ---
+# Large ERP exports are streamed with pd.read_csv(chunksize=...) and committed per chunk.
+# Progress is checkpointed per file (keyed by a content fingerprint) so an interrupted
+# upload resumes after the last committed chunk when the same file is uploaded again.
+CSV_IMPORT_STATE_FILE = "csv_import_state.json"
+CSV_CHUNK_SIZE = 5000
+
+def csv_fingerprint(file_obj):
+    """Identify an upload by size + hash of its first 1 MB (stream position is preserved)."""
+    import hashlib
+    pos = file_obj.tell()
+    file_obj.seek(0, 2)
+    size = file_obj.tell()
+    file_obj.seek(0)
+    head = file_obj.read(1024 * 1024)
+    file_obj.seek(pos)
+    if isinstance(head, str):
+        head = head.encode("utf-8")
+    return f"{size}-{hashlib.sha1(head).hexdigest()}"
+
+def _load_csv_import_state():
+    import json, os
+    if os.path.exists(CSV_IMPORT_STATE_FILE):
         try:
-            # Extract Customer Data
-            company = str(row.get('상호명', '')).strip()
-            if not company or company == 'nan':
+            with open(CSV_IMPORT_STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+    return {}
+
+def _save_csv_import_state(state):
+    import json, os
+    tmp_path = CSV_IMPORT_STATE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, CSV_IMPORT_STATE_FILE)
+
+def get_csv_import_checkpoint(file_obj):
+    """Returns the saved checkpoint dict for this file ({'chunks_done', 'stats'}) or None."""
+    return _load_csv_import_state().get(csv_fingerprint(file_obj))
+
+def import_csv_in_chunks(db: Session, file_obj, chunksize=CSV_CHUNK_SIZE, progress_callback=None):
+    """
+    Stream a CSV into the DB chunk by chunk via process_csv_data (one commit per chunk).
+    Memory stays at one chunk regardless of file size.
+    progress_callback(fraction: float, chunks_done: int) is called after each chunk.
+    The checkpoint only advances past committed chunks: a chunk that rolled back stops
+    the import, and uploading the same file again retries from that chunk.
+    'errors' counts the rows process_csv_data skipped.
+    Returns the combined stats dict plus 'resumed_from' (number of chunks skipped) and
+    'completed' (False if a chunk failed).
+    """
+    fingerprint = csv_fingerprint(file_obj)
+    state = _load_csv_import_state()
+    entry = state.get(fingerprint) or {"chunks_done": 0, "stats": {"new_customers": 0, "new_orders": 0, "errors": 0}}
+    resume_from = entry["chunks_done"]
+    stats = dict(entry["stats"])
+    failed = False
+    # Company -> id for the whole import (one prefetch instead of one per chunk)
+    customer_ids = dict(db.query(Customer.company_name, Customer.id).all())
+    
+    file_obj.seek(0, 2)
+    total_size = file_obj.tell() or 1
+    file_obj.seek(0)
+    
+    # Context manager so pandas detaches (instead of closing) the caller's file on errors
+    with pd.read_csv(file_obj, chunksize=chunksize) as reader:
+        for i, chunk in enumerate(reader):
+            if i < resume_from:
+                # Already committed in a previous (interrupted) run
                 continue
-                
-            # '담당자' Logic
-            sales_rep = ""
-            client_name = ""
-            
-            if len(manager_indices) >= 1:
-                sales_rep = str(row.iloc[manager_indices[0]]).strip()
-            if len(manager_indices) >= 2:
-                client_name = str(row.iloc[manager_indices[1]]).strip()
-            if sales_rep == 'nan': sales_rep = ""
-            if client_name == 'nan': client_name = ""
-
-            phone = str(row.get('연락처', '')).strip()
-            if phone == 'nan': phone = ""
-            
-            industry = str(row.get('업종', '')).strip()
-            if industry == 'nan': industry = ""
-            
-            # Check/Create Customer
-            customer = db.query(Customer).filter(Customer.company_name == company).first()
-            if not customer:
-                customer = Customer(
-                    company_name=company,
-                    client_name=client_name,
-                    phone=phone,
-                    industry=industry,
-                    sales_rep=sales_rep
-                )
-                db.add(customer)
-                db.commit()
-                db.refresh(customer)
-                stats['new_customers'] += 1
             
-            # Extract Order Data
-            import re
-            def clean_number(val):
-                # Extract all numbers from string (handling integers and floats)
-                val_str = str(val)
-                if not val_str or val_str.lower() == 'nan': return 0
-                
-                # Find all numbers (e.g. "1,000" -> "1000", "500/600" -> ["500", "600"])
-                # Remove commas first
-                val_str = val_str.replace(',', '')
-                # Find digits (allowing for decimals)
-                matches = re.findall(r'-?\d+\.?\d*', val_str)
-                
-                if not matches: return 0
-                
-                # Strategy: Sum all found numbers (assuming "500/500" means two items worth 500 each)
-                # This is a heuristic for messy data.
-                total = sum(float(m) for m in matches)
-                return int(total)
-            
-            total_amt = clean_number(row.get('총가격', 0))
-            deposit_amt = clean_number(row.get('입금액', 0))
-            qty = clean_number(row.get('수량', 0))
-            
-            prod_name = str(row.get('상품명', ''))
-            if prod_name == 'nan': prod_name = None
-            
-            note = str(row.get('비고', ''))
-            if note == 'nan': note = None
-            
-            order_date_str = str(row.get('날짜', ''))
             try:
-                # Try parsing date 
-                # Pandas to_datetime is smart but might fail on really weird stuff
-                order_date = pd.to_datetime(order_date_str).date()
-            except:
-                order_date = date.today()
-
-            # Create Order
-            new_order = Order(
-                customer_id=customer.id,
-                order_date=order_date,
-                product_name=prod_name,
-                quantity=qty,
-                total_amount=total_amt,
-                deposit_amount=deposit_amt,
-                is_ordered=True,
-                note=note
-            )
-            db.add(new_order)
-            stats['new_orders'] += 1
+                chunk_stats = process_csv_data(db, chunk, customer_ids)
+            except Exception as e:
+                # Rolled back (e.g. "database is locked"): keep the checkpoint before this chunk
+                print(f"CSV import error (chunk {i + 1}): {e}")
+                failed = True
+                break
+            for k in stats:
+                stats[k] += chunk_stats.get(k, 0)
             
-        except Exception as e:
-            # print(f"Error processing row: {e}") # Reduce noise
-            stats['errors'] += 1
+            entry = {"chunks_done": i + 1, "stats": stats}
+            state[fingerprint] = entry
+            _save_csv_import_state(state)
             
-    db.commit()
+            if progress_callback:
+                progress_callback(min(1.0, file_obj.tell() / total_size), i + 1)
+    
+    if not failed:
+        # Finished -> forget the checkpoint so a deliberate re-upload imports again
+        state.pop(fingerprint, None)
+        _save_csv_import_state(state)
+        
+        if progress_callback:
+            progress_callback(1.0, entry["chunks_done"])
+    
+    stats["resumed_from"] = resume_from
+    stats["completed"] = not failed
     return stats
 
 # --- NEW: PRODUCT & QUOTE UTILS ---
@@ -870,10 +1295,88 @@ def delete_customer(db: Session, customer_id: int):
         print(f"Delete Customer Error: {e}")
         return False
 
+# --- AI Response Cache ---
+# Repeat analyses of the same text (reruns, failed saves) are answered from the
+# ai_response_cache table instead of a new generate_content call.
+# Bump AI_PROMPT_VERSION whenever the prompt below changes, so old answers stop matching.
+AI_PROMPT_VERSION = "v4"
+AI_CACHE_TTL_HOURS = int(get_setting("AI_CACHE_TTL_HOURS", 24 * 7))
+AI_CACHE_MAX_ENTRIES = int(get_setting("AI_CACHE_MAX_ENTRIES", 1000))
+
+def ai_cache_key(model_name: str, text: str, product_names: list = None):
+    import hashlib, json
+    products_hash = hashlib.sha256("\n".join(sorted(product_names or [])).encode("utf-8")).hexdigest()
+    payload = json.dumps([model_name, AI_PROMPT_VERSION, text, products_hash], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _count_ai_cache_lookup(db: Session, name: str):
+    """+1 on the "hits"/"misses" counter (inside the caller's transaction)."""
+    table = AICacheCounter.__table__
+    conn = db.connection()
+    result = conn.execute(table.update().where(table.c.name == name).values(count=table.c.count + 1))
+    if not result.rowcount:
+        # Rows are seeded by migration v12; only missing right after a reset
+        conn.execute(table.insert().values(name=name, count=1))
+
+def get_cached_ai_response(db: Session, key: str):
+    """Returns the cached result dict, or None if missing/expired. Counts the hit/miss."""
+    import json
+    from datetime import timedelta
+    entry = db.get(AIResponseCache, key)
+    now = datetime.now()
+    if entry is not None and entry.created_at < now - timedelta(hours=AI_CACHE_TTL_HOURS):
+        db.delete(entry)
+        entry = None
+    if entry is None:
+        _count_ai_cache_lookup(db, "misses")
+        db.commit()
+        return None
+    entry.hits = (entry.hits or 0) + 1
+    entry.last_hit_at = now
+    _count_ai_cache_lookup(db, "hits")
+    db.commit()
+    return json.loads(entry.response)
+
+def store_ai_response(db: Session, key: str, model_name: str, result: dict):
+    """Saves a successful result, then drops expired entries and the least recently used beyond AI_CACHE_MAX_ENTRIES."""
+    import json
+    from datetime import timedelta
+    now = datetime.now()
+    db.merge(AIResponseCache(
+        key=key,
+        model=model_name,
+        prompt_version=AI_PROMPT_VERSION,
+        response=json.dumps(result, ensure_ascii=False),
+        hits=0,
+        created_at=now,
+        last_hit_at=now
+    ))
+    db.flush()
+    
+    db.query(AIResponseCache).filter(
+        AIResponseCache.created_at < now - timedelta(hours=AI_CACHE_TTL_HOURS)
+    ).delete(synchronize_session=False)
+    count = db.query(func.count(AIResponseCache.key)).scalar()
+    if count > AI_CACHE_MAX_ENTRIES:
+        oldest = [k for (k,) in db.query(AIResponseCache.key).order_by(AIResponseCache.last_hit_at).limit(count - AI_CACHE_MAX_ENTRIES)]
+        db.query(AIResponseCache).filter(AIResponseCache.key.in_(oldest)).delete(synchronize_session=False)
+    db.commit()
+
+def get_ai_cache_stats(db: Session):
+    """All-time hits/misses (hits = saved API calls), hit rate (%) and stored entries."""
+    counts = dict(db.query(AICacheCounter.name, AICacheCounter.count).all())
+    hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+    entries = db.query(func.count(AIResponseCache.key)).scalar()
+    hit_rate = round(100 * hits / (hits + misses), 1) if hits + misses else 0.0
+    return {"hits": hits, "misses": misses, "hit_rate": hit_rate, "entries": entries}
+
 def analyze_text_with_gemini_v4(api_key: str, text: str, product_names: list[str] = None):
     """
     V4: Classify type (Quote/Order/Strategy/Memo) and Extract Summary.
-    Returns: JSON with 'classification', 'summary', 'customer', 'products'
+    Returns: (result, from_cache)
+      result: JSON with 'classification', 'summary', 'customer', 'products' (or 'error')
+      from_cache: True if answered from ai_response_cache (identical model,
+      AI_PROMPT_VERSION, text and products) instead of an API call.
     """
     import google.generativeai as genai
     import json
@@ -885,6 +1388,17 @@ def analyze_text_with_gemini_v4(api_key: str, text: str, product_names: list[str
     except:
         model = genai.GenerativeModel('gemini-2.0-flash-exp') # Fallback
     
+    # Cache lookup (a cache failure never blocks the analysis)
+    model_name = model.model_name
+    cache_key = ai_cache_key(model_name, text, product_names)
+    try:
+        with session_scope() as db:
+            cached = get_cached_ai_response(db, cache_key)
+        if cached is not None:
+            return cached, True
+    except Exception as e:
+        print(f"AI cache read error: {e}")
+    
     valid_products_str = ", ".join(product_names) if product_names else "None supplied"
     
     prompt = f"""
@@ -940,9 +1454,17 @@ def analyze_text_with_gemini_v4(api_key: str, text: str, product_names: list[str
         if raw_text.startswith("```json"): raw_text = raw_text[7:]
         if raw_text.startswith("```"): raw_text = raw_text[3:]
         if raw_text.endswith("```"): raw_text = raw_text[:-3]
-        return json.loads(raw_text)
+        result = json.loads(raw_text)
+    except Exception as e:
+        return {"error": str(e)}, False
+    
+    # Only successful answers are cached
+    try:
+        with session_scope() as db:
+            store_ai_response(db, cache_key, model_name, result)
     except Exception as e:
-        return {"error": str(e)}
+        print(f"AI cache write error: {e}")
+    return result, False
 
 def reset_database(db: Session):
     """